@@ -0,0 +1,144 @@
+#This script compares the memory and time needed to collect the MBF values
+#of a territory made of many labels: the former ReadTerritoryMBF, that
+#thresholds every label and grows the array with np.append, against the
+#ReadTerritoryMBF of ExtractFlowPrePost, a single gather through the
+#territory index. Both run on a case folder as the analysis reads it (a
+#synthetic one by default). The index is stored before the runs, and the
+#time to read the case and its index is reported apart from the collection
+
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import vtk
+from argparse import Namespace
+from multiprocessing import get_context
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+from ExtractFlowPrePost import ExtractFlowPrePost
+from utilities import ReadVTUFile, ReadTerritoryIndex
+
+def MakeCase(Folder, NCells, NLabels):
+    #Voxel mesh with blocks of slices sharing a label, like territories in a
+    #myocardium, and the labels file of the territory maps
+    n = int(round(NCells**(1/3)))+1
+    Image = vtk.vtkImageData()
+    Image.SetDimensions(n, n, n)
+    Image.SetSpacing(0.1, 0.1, 0.1)
+    rng = np.random.default_rng(0)
+    Scalars = numpy_to_vtk(rng.normal(100, 10, n**3).astype(np.float32), deep=1)
+    Scalars.SetName("scalars")
+    Image.GetPointData().AddArray(Scalars)
+    Labels = numpy_to_vtk((np.arange(n**3) % n)*NLabels//n, deep=1)
+    Labels.SetName("TerritoryMaps")
+    Image.GetPointData().AddArray(Labels)
+    Mesh = vtk.vtkAppendFilter()
+    Mesh.SetInputData(Image)
+    Mesh.Update()
+    writer = vtk.vtkXMLUnstructuredGridWriter()
+    writer.SetFileName(os.path.join(Folder, "MBF_Territories.vtu"))
+    writer.SetInputData(Mesh.GetOutput())
+    writer.Write()
+    with open(os.path.join(Folder, "MBF_Territories_Labels.dat"), "w") as ofile:
+        ofile.write("Label Territory\n")
+        for i in range(NLabels):
+            ofile.write(f"{i} L_LAD_{i}.vtp\n")
+
+#ThresholdInBetween and ReadTerritoryMBF of ExtractFlowPrePost before the
+#territory index, kept here as the reference
+def ThresholdInBetween(Volume, arrayname, value1, value2):
+    Threshold=vtk.vtkThreshold()
+    Threshold.SetInputData(Volume)
+    Threshold.SetLowerThreshold(value1)
+    Threshold.SetUpperThreshold(value2)
+    Threshold.SetInputArrayToProcess(0,0,0,vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS,arrayname)
+    Threshold.Update()
+    return Threshold.GetOutput()
+
+def ReadTerritoryMBFAppend(MBFMap, MBF_Labels, ArrayName):
+    MBF_data = {}
+    Territories = {}
+    for key in MBF_Labels.keys():
+        MBF_data[key] = np.array([])
+        AppendTerritory = vtk.vtkAppendFilter()
+        for i in MBF_Labels[key]:
+            territory_ = ThresholdInBetween(MBFMap, "TerritoryMaps", i, i)
+            AppendTerritory.AddInputData(territory_)
+            MBF_ = vtk_to_numpy(territory_.GetCellData().GetArray(ArrayName))
+            MBF_data[key] = np.append(MBF_, MBF_data[key])
+        AppendTerritory.Update()
+        Territories[key] = AppendTerritory.GetOutput()
+
+    return MBF_data, Territories
+
+def ResetPeakRSS():
+    #Resets the high-water mark (VmHWM) of the process, Linux only
+    try:
+        with open("/proc/self/clear_refs", "w") as ofile:
+            ofile.write("5")
+        return True
+    except OSError:
+        return False
+
+def ProcessRSS(Field):
+    #VmRSS (current) or VmHWM (peak since the last reset) in MB
+    with open("/proc/self/status") as ifile:
+        for line in ifile:
+            if line.startswith(Field):
+                return int(line.split()[1])/1024
+    return np.nan
+
+def RunCollector(Method, InputFolder):
+    #Runs in a new process that only holds the inputs, so the peaks belong to
+    #one method. The RSS peak includes the VTK filters, the traced peak only
+    #the NumPy and Python allocations
+    args = Namespace(InputFolder=InputFolder, InputMBF="MBF_Territories.vtu", InputLabels="MBF_Territories_Labels.dat",
+                     TerritoryTag=["LAD"], Unit="mm", ExcludeLayers=0)
+    Analysis = ExtractFlowPrePost(args)
+    Analysis.InputLabels = os.path.join(InputFolder, args.InputLabels)
+    MBFLabels = Analysis.ReadMBFLabels()
+    Start = time.perf_counter()
+    MBF, TerritoryIndex = Analysis.ReadCaseFile("A")
+    ReadTime = time.perf_counter() - Start
+    MBF = Analysis.ConvertPointDataToCellData(MBF)
+    ScalarArray = Analysis.FindScalarArray(MBF)
+
+    HasPeak = ResetPeakRSS()
+    Baseline = ProcessRSS("VmRSS") if HasPeak else np.nan
+    tracemalloc.start()
+    Start = time.perf_counter()
+    if Method == "append":
+        MBF_data, _ = ReadTerritoryMBFAppend(MBF, MBFLabels, ScalarArray)
+    else:
+        MBF_data, _ = Analysis.ReadTerritoryMBF(MBF, MBFLabels, ScalarArray, TerritoryIndex)
+    Elapsed = time.perf_counter() - Start
+    _, Traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    Peak = ProcessRSS("VmHWM") if HasPeak else np.nan
+
+    NValues = sum(len(Values) for Values in MBF_data.values())
+    return ReadTime, Elapsed, Peak - Baseline, Traced/1024**2, NValues
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the collection of territory MBF values with np.append against an index gather.")
+    parser.add_argument("-InputFolder", "--InputFolder", type= str, required= False, default= None, dest= "InputFolder", help= "Case folder with MBF_Territories.vtu and MBF_Territories_Labels.dat (default: a synthetic case)")
+    parser.add_argument("-NCells", "--NCells", type= int, required= False, default= 2000000, dest= "NCells", help= "Number of cells in the synthetic mesh")
+    parser.add_argument("-NLabels", "--NLabels", type= int, required= False, default= 25, dest= "NLabels", help= "Number of labels merged into the territory")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as TemporaryFolder:
+        InputFolder = args.InputFolder
+        if InputFolder is None:
+            InputFolder = TemporaryFolder
+            MakeCase(InputFolder, args.NCells, args.NLabels)
+        InputMBF = os.path.join(InputFolder, "MBF_Territories.vtu")
+        MBF = ReadVTUFile(InputMBF)
+        ReadTerritoryIndex(InputMBF, MBF)
+        print(f"--- Collecting the LAD labels of {InputFolder} ({MBF.GetNumberOfCells()} cells)")
+        print("Method, Read Time (s), Collection Time (s), Peak RSS increase (MB), Peak traced (MB), Values")
+        del MBF
+        for Method in ("append", "gather"):
+            with get_context("spawn").Pool(1) as pool:
+                ReadTime, Elapsed, PeakRSS, Traced, NValues = pool.apply(RunCollector, (Method, InputFolder))
+            print(f"{Method}, {ReadTime:.3f}, {Elapsed:.3f}, {PeakRSS:.1f}, {Traced:.1f}, {NValues}")
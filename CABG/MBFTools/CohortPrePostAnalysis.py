@@ -0,0 +1,157 @@
+#This script runs the pre/post CABG analysis of ExtractFlowPrePost over a
+#whole cohort. Every patient has a pre-CABG folder ending with "A" and a
+#post-CABG folder ending with "B" (e.g. CABG12A and CABG12B). The patients
+#are analyzed in a pool of worker processes, each limited in memory, failed
+#patients are retried, and the statistics of every territory are written
+#to one table (Parquet or CSV)
+
+import os
+import time
+import resource
+import argparse
+from glob import glob
+from multiprocessing import util
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from ExtractFlowPrePost import ExtractFlowPrePost
+from ReportFigures import FigureReport
+
+def DiscoverPatients(CohortFolder, InputMBF):
+    #Pre-CABG folders that have a post-CABG folder and an MBF map in both
+    Folders = []
+    for FolderA in sorted(glob(os.path.join(CohortFolder, "*A"))):
+        FolderB = f"{FolderA[:-1]}B"
+        if os.path.isfile(os.path.join(FolderA, InputMBF)) and os.path.isfile(os.path.join(FolderB, InputMBF)):
+            Folders.append(FolderA)
+
+    return Folders
+
+def LimitMemory(MemoryLimit):
+    #Address space cap of a worker (MB): a patient that needs more fails with
+    #a MemoryError instead of taking the memory of the other workers
+    if MemoryLimit > 0:
+        Limit = MemoryLimit*1024**2
+        resource.setrlimit(resource.RLIMIT_AS, (Limit, Limit))
+
+#One report per worker process, reused by all the patients of the worker
+WorkerReport = None
+
+def AnalyzePatient(FolderA, Options):
+    global WorkerReport
+    args = Namespace(InputFolder=FolderA, **Options)
+    if args.ReportFolder is not None and WorkerReport is None:
+        #Opened before the first analysis of the worker, so its warm-up runs
+        #meanwhile. The pool shuts its thread down with the worker
+        WorkerReport = FigureReport(args.ReportFolder)
+        util.Finalize(WorkerReport, WorkerReport.Close, exitpriority=10)
+    Analysis = ExtractFlowPrePost(args)
+    Analysis.InputLabels = os.path.join(Analysis.CaseFolder("B"), args.InputLabels)
+    MBFLabels = Analysis.ReadMBFLabels()
+    Results_A = Analysis.AnalyzeCase("A", MBFLabels)
+    Results_B = Analysis.AnalyzeCase("B", MBFLabels)
+
+    Patient = os.path.basename(os.path.normpath(FolderA))[:-1]
+    Rows = PatientRows(Patient, "PreCABG", Results_A) + PatientRows(Patient, "PostCABG", Results_B)
+
+    if args.ReportFolder is not None:
+        Analysis.Report = WorkerReport
+        Bardata = {"Territory": [], "Time": [], "Value": []}
+        for key in Results_A["IndexMBFStat"].keys():
+            Bardata["Territory"].extend([key, key])
+            Bardata["Time"].extend(["PreCABG", "PostCABG"])
+            Bardata["Value"].extend([Results_A["IndexMBFStat"][key]['Mean'], Results_B["IndexMBFStat"][key]['Mean']])
+        Analysis.BarPlot(Bardata, "Average Index MBF", "IndexMBF")
+        #The figure is saved by the worker before the patient is done, so a
+        #drawing error fails this patient and not the next one
+        WorkerReport.Wait()
+
+    return Rows
+
+def PatientRows(Patient, Time, Results):
+    #One row per territory (and the whole myocardium) of one case
+    Rows = []
+    Territories = [("Myocardium", Results["stats"], Results["index_stats"])]
+    Territories += [(key, Results["MBFStat"][key], Results["IndexMBFStat"][key]) for key in Results["MBFStat"].keys()]
+    for (key, Stat, IndexStat) in Territories:
+        Row = {"Patient": Patient, "Time": Time, "Territory": key}
+        for (Name, Value) in Stat.items():
+            Row[f"MBF_{Name}"] = Value
+        for (Name, Value) in IndexStat.items():
+            Row[f"IndexMBF_{Name}"] = Value
+        Row["Volume (mL)"] = Results["Volume"].get(key, np.nan)
+        Row["Flow (mL/min)"] = np.sum(Results["Flow"][key]) if key in Results["Flow"] else np.nan
+        Row["IndexFlow"] = np.sum(Results["IndexFlow"][key]) if key in Results["IndexFlow"] else np.nan
+        Row["MBF_Reference75th"] = Results["perc75"]
+        Row["VoxelSize (mm^3)"] = Results["VoxelSize"]*1000
+        Rows.append(Row)
+
+    return Rows
+
+def RunCohort(Folders, Options, Processes, MemoryLimit, Retries):
+    #A patient that fails is submitted again up to Retries times. If a worker
+    #dies (e.g. killed by the operating system) the pool is broken, so every
+    #patient still in it counts as failed and a new pool is started
+    Rows = []
+    Failed = {}
+    Attempts = {Folder: 0 for Folder in Folders}
+    Pending = list(Folders)
+    while len(Pending) > 0:
+        with ProcessPoolExecutor(Processes, initializer=LimitMemory, initargs=(MemoryLimit,)) as pool:
+            Futures = {pool.submit(AnalyzePatient, Folder, Options): Folder for Folder in Pending}
+            Pending = []
+            for Future in as_completed(Futures):
+                Folder = Futures[Future]
+                try:
+                    Rows.extend(Future.result())
+                    Failed.pop(Folder, None)
+                    print(f"--- Done: {Folder}")
+                except Exception as e:
+                    Attempts[Folder] += 1
+                    Failed[Folder] = f"{type(e).__name__}: {e}"
+                    if Attempts[Folder] <= Retries:
+                        print(f"--- Failed, retrying: {Folder} ({Failed[Folder]})")
+                        Pending.append(Folder)
+                    else:
+                        print(f"--- Failed: {Folder} ({Failed[Folder]})")
+
+    return pd.DataFrame(Rows), Failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pre/post CABG analysis over every patient of a cohort.")
+    parser.add_argument("-CohortFolder", "--CohortFolder", type= str, required= True, dest= "CohortFolder", help= "Folder with the ...A and ...B folders of every patient")
+    parser.add_argument("-OutputFile", "--OutputFile", type= str, required= False, default= None, dest= "OutputFile", help= "Statistics table (.parquet or .csv)")
+    parser.add_argument("-InputMBF", "--InputMBF", dest= "InputMBF", type= str, required= False, default= "MBF_Territories.vtu")
+    parser.add_argument("-InputLabels", "--InputLabels", dest= "InputLabels", type= str, required= False, default="MBF_Territories_Labels.dat")
+    parser.add_argument("-TerritoryTag", "--TerritoryTag", type= str, required=True, nargs= "+", dest = "TerritoryTag")
+    parser.add_argument("-Unit", "--Unit", type= str, dest= "Unit", default="cm", required=False)
+    parser.add_argument("-ExcludeLayers", "--ExcludeLayers", type= int, dest= "ExcludeLayers", default= 0, required= False, help= "Number of boundary layers (LayerIndex) to leave out of the analysis")
+    parser.add_argument("-Processes", "--Processes", type= int, dest= "Processes", default= os.cpu_count(), required= False, help= "Number of worker processes")
+    parser.add_argument("-MemoryLimit", "--MemoryLimit", type= int, dest= "MemoryLimit", default= 0, required= False, help= "Address space limit of every worker in MB (0: no limit)")
+    parser.add_argument("-Retries", "--Retries", type= int, dest= "Retries", default= 1, required= False, help= "Number of times a failed patient is run again")
+    parser.add_argument("-ReportFolder", "--ReportFolder", type= str, default= None, required= False, dest= "ReportFolder", help= "Save the Index MBF figure of every patient to this folder")
+    args = parser.parse_args()
+
+    Folders = DiscoverPatients(args.CohortFolder, args.InputMBF)
+    if len(Folders) == 0:
+        print(f"--- No patient folders (...A and ...B with {args.InputMBF}) found in {args.CohortFolder}")
+        exit(1)
+    print(f"--- Found {len(Folders)} patients")
+
+    Options = {"InputMBF": args.InputMBF, "InputLabels": args.InputLabels, "ArrayName": 0, "TerritoryTag": args.TerritoryTag,
+               "Unit": args.Unit, "ExcludeLayers": args.ExcludeLayers, "Parallel": False, "ReportFolder": args.ReportFolder}
+    Start = time.perf_counter()
+    Table, Failed = RunCohort(Folders, Options, args.Processes, args.MemoryLimit, args.Retries)
+    print(f"--- {len(Folders)-len(Failed)} of {len(Folders)} patients analyzed in {time.perf_counter()-Start:.1f} s")
+    for (Folder, Error) in Failed.items():
+        print(f"Failed: {Folder}, {Error}")
+
+    ofile_path = args.OutputFile
+    if ofile_path is None:
+        ofile_path = os.path.join(args.CohortFolder, "PrePostStatistics.parquet")
+    if ofile_path.endswith(".parquet"):
+        Table.to_parquet(ofile_path, index=False)
+    else:
+        Table.to_csv(ofile_path, index=False)
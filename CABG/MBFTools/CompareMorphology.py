@@ -4,10 +4,13 @@ import argparse
 import numpy as np
 import pandas as pd
 import seaborn as sns
-import matplotlib.pyplot as plt
+from matplotlib.artist import setp
 from vtk.util.numpy_support import vtk_to_numpy
 from PrePostComparison import PrePostMBFMap
-from utilities import ReadVTPFile, ReadVTUFile, WriteVTPFile
+from ReportFigures import FigureReport, PlotFigure, ReportFileName
+from utilities import ReadVTPFile, ReadVTUFile, WriteVTPFile, GetPointArray, LabelGroupSummaries, VertexAreas
+from utilities import GetPointCoordinates, TriangleLocator, SurfaceAddArray, SurfaceAddCellArray, TransferArrays
+from utilities import TriangulateSurface, SurfaceProperties, RemoveBoundaryLayers
 
 class CompareMorphology(PrePostMBFMap):
     def __init__(self, args):
@@ -18,97 +21,72 @@ class CompareMorphology(PrePostMBFMap):
         self.CavityCapped_A = ReadVTPFile(f"{InputFolderA}/Morphology/{args.CavityCapped}")
         self.Endocardium_A = ReadVTPFile(f"{InputFolderA}/Morphology/{args.Endocardium}")
         self.Epicardium_A = ReadVTPFile(f"{InputFolderA}/Morphology/{args.Epicardium}")
-        self.MBFTerritories_A = ReadVTUFile(f"{InputFolderA}/{args.MBFTerritories}")
+        self.MBFTerritories_A = RemoveBoundaryLayers(ReadVTUFile(f"{InputFolderA}/{args.MBFTerritories}"), args.ExcludeLayers)
         self.output_surface_A = os.path.join(f"{InputFolderA}/Morphology", os.path.splitext(args.Epicardium)[0] + "_WallThickness.vtp")
 
         self.CavityCapped_B = ReadVTPFile(f"{InputFolderB}/Morphology/{args.CavityCapped}")
         self.Endocardium_B = ReadVTPFile(f"{InputFolderB}/Morphology/{args.Endocardium}")
         self.Epicardium_B = ReadVTPFile(f"{InputFolderB}/Morphology/{args.Epicardium}")
-        self.MBFTerritories_B = ReadVTUFile(f"{InputFolderB}/{args.MBFTerritories}")
+        self.MBFTerritories_B = RemoveBoundaryLayers(ReadVTUFile(f"{InputFolderB}/{args.MBFTerritories}"), args.ExcludeLayers)
         self.output_surface_B = os.path.join(f"{InputFolderB}/Morphology", os.path.splitext(args.Epicardium)[0] + "_WallThickness.vtp")
 
-    def ComputeVolume(self, ClosedSurface):
-        surface = self.TriangulateSurface(ClosedSurface)
-        MassProp = vtk.vtkMassProperties()
-        MassProp.SetInputData(surface)
-        MassProp.Update()
-        
-        return MassProp.GetVolume()
-    
     def ComputeSurfaceArea(self, Surface):
-        surface = self.TriangulateSurface(Surface)
-        MassProp = vtk.vtkMassProperties()
-        MassProp.SetInputData(surface)
-        MassProp.Update()
-
-        return MassProp.GetSurfaceArea()
+        #Triangulated and measured once per surface, shared with ComputeVolume
+        #and ComputeWallThickness
+        return SurfaceProperties(Surface)["SurfaceArea"]
 
     def ComputeWallThickness(self, Endocardium, Epicardium):
-        epicardium = self.TriangulateSurface(Epicardium)
+        #Unsigned distance of every epicardial point (and cell centre) to the
+        #closest endocardial triangle, as vtkDistancePolyDataFilter gives, and
+        #the id of that triangle (ClosestCellId) for later use
+        #The triangulated surfaces are cached, the arrays go on a copy
+        epicardium = vtk.vtkPolyData()
+        epicardium.ShallowCopy(self.TriangulateSurface(Epicardium))
         endocardium = self.TriangulateSurface(Endocardium)
-        distancefilter = vtk.vtkDistancePolyDataFilter()
-        distancefilter.SetInputData(1, endocardium)
-        distancefilter.SetInputData(0, epicardium)
-        distancefilter.SignedDistanceOff()
-        distancefilter.Update()
+        Locator = TriangleLocator(endocardium)
+        Distance, ClosestCellId = Locator.FindClosestCells(GetPointCoordinates(epicardium))
 
-        return distancefilter.GetOutput()
-    
-    def TriangulateSurface(self, Surface):
-        tri_filter = vtk.vtkTriangleFilter()
-        tri_filter.SetInputData(Surface)
-        tri_filter.Update()
+        CellCenters = vtk.vtkCellCenters()
+        CellCenters.SetInputData(epicardium)
+        CellCenters.Update()
+        CellDistance, _ = Locator.FindClosestCells(GetPointCoordinates(CellCenters.GetOutput()))
 
-        cleaner = vtk.vtkCleanPolyData()
-        cleaner.SetInputData(tri_filter.GetOutput())
-        cleaner.Update()
+        SurfaceAddArray(epicardium, Distance, "Distance")
+        SurfaceAddArray(epicardium, ClosestCellId, "ClosestCellId")
+        SurfaceAddCellArray(epicardium, CellDistance, "Distance")
 
-        return cleaner.GetOutput()
+        return epicardium
+    
+    def TriangulateSurface(self, Surface):
+        return TriangulateSurface(Surface)
     
     def ProjectTerritories(self, Surface, Volume):
-        TerritoyProfile_Array = vtk.vtkFloatArray()
-        TerritoyProfile_Array.SetName("TerritoryMaps")
-        TerritoyProfile_Array.SetNumberOfComponents(1)
-        TerritoyProfile_Array.SetNumberOfTuples(Surface.GetNumberOfPoints())
+        return TransferArrays(Volume, Surface, ["TerritoryMaps"])
 
-        TerritoryMap = Volume.GetPointData().GetArray("TerritoryMaps")
+    def SummarizeWallThicknessInTerritory(self, Surface):
+        #Mean, median, quartiles and area-weighted mean of the wall thickness of
+        #every territory, grouping the surface points by their projected label
+        MBF_Labels = {key: item for (key, item) in super().ReadMBFLabels().items() if len(item) > 0}
+        Labels = np.rint(GetPointArray(Surface, "TerritoryMaps")).astype(np.int64)
 
-        Locator = vtk.vtkPointLocator()
-        Locator.SetDataSet(Volume)
-        Locator.BuildLocator()
+        return LabelGroupSummaries(Labels, GetPointArray(Surface, "Distance"), MBF_Labels, VertexAreas(Surface))
 
-        for i in range(Surface.GetNumberOfPoints()):
-            point = Surface.GetPoint(i)
-            closest_point_id = Locator.FindClosestPoint(point)
-
-            TerritoyProfile_Array.SetValue(i, TerritoryMap.GetValue(closest_point_id))
-
-        Surface.GetPointData().AddArray(TerritoyProfile_Array)
-
-        return Surface
-
-    def ExtractWallThicknessInTerritory(self, Surface):
-        MBF_Labels = super().ReadMBFLabels()
-        WallThickness_data = dict()
-        for key in MBF_Labels.keys():
-            if len(MBF_Labels[key]) > 0: 
-                WallThickness_data[key] = np.array([])
-                for i in MBF_Labels[key]:
-                    territory_ = self.ThresholdInBetweenPoints(Surface, "TerritoryMaps", i, i)
-                    wall_thickness = vtk_to_numpy(territory_.GetPointData().GetArray("Distance"))
-                    WallThickness_data[key] = np.append(wall_thickness, WallThickness_data[key])
-
-        return WallThickness_data
+    def WriteWallThicknessSummary(self, OutputFile, Summary):
+        Table = pd.DataFrame.from_dict(Summary, orient="index")
+        Table = Table.rename(columns={"WeightedMean": "AreaWeightedMean", "Weight": "Area"})
+        Table.to_csv(OutputFile, index_label="Territory")
 
     def PlotResults(self, data):
+        PlotFigure(self.Report, "Morphology", ReportFileName(self.args.InputFolder, "Morphology"), (8, 5), self.DrawResults, data)
+
+    def DrawResults(self, fig, data):
         df = pd.DataFrame(data)
-        plt.figure(figsize=(8, 5))
-        sns.barplot(data=df, x="parameter", y="Value", hue="Time", palette="Set2")
+        ax = fig.add_subplot()
+        sns.barplot(data=df, x="parameter", y="Value", hue="Time", palette="Set2", ax=ax)
 
-        plt.ylabel("Value (units vary)")
-        plt.xticks(rotation=45, ha="right")
-        plt.tight_layout()
-        plt.show()
+        ax.set_ylabel("Value (units vary)")
+        setp(ax.get_xticklabels(), rotation=45, ha="right")
+        fig.tight_layout()
 
     def main(self):
         Volume_A = self.ComputeVolume(self.CavityCapped_A)
@@ -147,17 +125,26 @@ class CompareMorphology(PrePostMBFMap):
         WriteVTPFile(self.output_surface_A, Epicardium_WT_Territory_A)
         WriteVTPFile(self.output_surface_B, Epicardium_WT_Territory_B)
 
-        WallThickness_Data_A = self.ExtractWallThicknessInTerritory(Epicardium_WT_Territory_A)
-        WallThickness_Data_B = self.ExtractWallThicknessInTerritory(Epicardium_WT_Territory_B)
+        WallThickness_Summary_A = self.SummarizeWallThicknessInTerritory(Epicardium_WT_Territory_A)
+        WallThickness_Summary_B = self.SummarizeWallThicknessInTerritory(Epicardium_WT_Territory_B)
+        self.WriteWallThicknessSummary(f"{os.path.splitext(self.output_surface_A)[0]}_Territories.csv", WallThickness_Summary_A)
+        self.WriteWallThicknessSummary(f"{os.path.splitext(self.output_surface_B)[0]}_Territories.csv", WallThickness_Summary_B)
 
-        for key in WallThickness_Data_A.keys():
-            print(key, np.mean(WallThickness_Data_A[key]), np.mean(WallThickness_Data_B[key]))
+        for key in WallThickness_Summary_A.keys():
+            Mean_A, Mean_B = WallThickness_Summary_A[key]["Mean"], WallThickness_Summary_B[key]["Mean"]
+            print(key, Mean_A, Mean_B)
             data["parameter"].extend([key, key])
             data["Time"].extend(["WallThickness-Pre (0.1mm)", "WallThickness-Post (0.1mm)"])
-            data["Value"].extend([np.mean(WallThickness_Data_A[key])*100, np.mean(WallThickness_Data_B[key])*100])
+            data["Value"].extend([Mean_A*100, Mean_B*100])
 
         #Epicardium_WT_Territory_A.GetPointData().GetArray("Distance")
+        Report = self.Report
+        if Report is None and getattr(self.args, "ReportFolder", None) is not None:
+            self.Report = FigureReport(self.args.ReportFolder)
         self.PlotResults(data)
+        if Report is None and self.Report is not None:
+            self.Report.Close()
+            self.Report = None
 
 
     def ThresholdInBetweenPoints(self, Surface, arrayname, value1, value2):
@@ -179,6 +166,8 @@ if __name__ == "__main__":
     parser.add_argument("-Endocardium", default= "Endocardium.vtp", required= False, type= str, dest= "Endocardium")
     parser.add_argument("-Epicardium", default= "Epicardium.vtp", required= False, type= str, dest= "Epicardium")
     parser.add_argument("-MBFTerritories", default= "MBF_Territories.vtu", required= False, type= str, dest= "MBFTerritories")
+    parser.add_argument("-ExcludeLayers", "--ExcludeLayers", type= int, dest= "ExcludeLayers", default= 0, required= False, help= "Number of boundary layers (LayerIndex) to leave out of the analysis")
 
+    parser.add_argument("-ReportFolder", "--ReportFolder", type= str, default= None, required= False, dest= "ReportFolder", help= "Save the figures to this folder instead of showing them")
     args = parser.parse_args()
     CompareMorphology(args).main()
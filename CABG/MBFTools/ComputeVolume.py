@@ -1,21 +1,8 @@
-import vtk
 import argparse
-from utilities import ReadVTPFile
+from utilities import ReadVTPFile, SurfaceProperties
 
 def ComputeVolume(Model):
-    tri_filter = vtk.vtkTriangleFilter()
-    tri_filter.SetInputData(Model)
-    tri_filter.Update()
-
-    cleaner = vtk.vtkCleanPolyData()
-    cleaner.SetInputData(tri_filter.GetOutput())
-    cleaner.Update()
-    
-    mass = vtk.vtkMassProperties()
-    mass.SetInputData(cleaner.GetOutput())
-    mass.Update()
-
-    return mass.GetVolume()
+    return SurfaceProperties(Model)["Volume"]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
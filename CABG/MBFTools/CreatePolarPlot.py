@@ -6,7 +6,7 @@ import argparse
 import numpy as np
 from scipy.spatial.transform import Rotation as R
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-from utilities import ReadVTPFile, WriteVTPFile, GetCentroid, ThresholdByUpper, ExtractSurface, PrintProgress
+from utilities import ReadVTPFile, WriteVTPFile, GetCentroid, ThresholdByUpper, ExtractSurface, PrintProgress, GetPointCoordinates, ClosestPointIds, GetCellEdges
 
 TessellationPath = os.path.abspath(f"{sys.path[0]}/..")
 sys.path.append(TessellationPath)
@@ -49,6 +49,9 @@ class CreatePolarPlot():
 
         self.R_max = args.PlotRadius
         self.Scale = args.Scale
+        self.Rings = args.Rings
+        self.Sectors = args.Sectors
+        self.SectorRings = args.SectorRings
 
     def Line(self, point1, point2, res):
         line = vtk.vtkLineSource()
@@ -115,31 +118,16 @@ class CreatePolarPlot():
     
     def CopyProfileToPolyData(self, old_polydata, Array, new_coords, ArrayNameDestination):
         new_points = vtk.vtkPoints()
-        for pt in new_coords:
-            new_points.InsertNextPoint(pt)
+        new_points.SetData(numpy_to_vtk(np.asarray(new_coords, dtype=np.float64), deep=True))
 
         new_polydata = vtk.vtkPolyData()
         new_polydata.SetPoints(new_points)
-        ProfileCopy = vtk.vtkFloatArray()
-        ProfileCopy.SetName(ArrayNameDestination)
-        ProfileCopy.SetNumberOfComponents(1)
-        ProfileCopy.SetNumberOfTuples(old_polydata.GetNumberOfPoints())
-
-        for j in range(old_polydata.GetNumberOfPoints()):
-            ProfileCopy.SetTuple(j, Array.GetTuple(j))
-
-        new_polydata.GetPointData().AddArray(ProfileCopy)
 
-        return new_polydata
+        return self.AddProfileToPolyData(new_polydata, Array, ArrayNameDestination)
     
     def AddProfileToPolyData(self, old_polydata, Array, ArrayNameDestination):
-        ProfileCopy = vtk.vtkFloatArray()
+        ProfileCopy = numpy_to_vtk(vtk_to_numpy(Array).astype(np.float32), deep=True)
         ProfileCopy.SetName(ArrayNameDestination)
-        ProfileCopy.SetNumberOfComponents(1)
-        ProfileCopy.SetNumberOfTuples(old_polydata.GetNumberOfPoints())
-
-        for j in range(old_polydata.GetNumberOfPoints()):
-            ProfileCopy.SetTuple(j, Array.GetTuple(j))
 
         old_polydata.GetPointData().AddArray(ProfileCopy)
 
@@ -168,16 +156,87 @@ class CreatePolarPlot():
         return idx
     
     def ReorderCoronaryMapBasedOnCenterLine(self, arbitrary_array, VesselCenterLine, new_points):
-        idx_array = []
-        for point in arbitrary_array:
-            idx_array.append(self.FindClosestPointToArray(VesselCenterLine, point))
-        sorted_idx = np.argsort(np.array(idx_array))
+        idx_array = ClosestPointIds(np.asarray(VesselCenterLine, dtype=np.float64), arbitrary_array)
+        sorted_idx = np.argsort(idx_array, kind="stable")
         new_points = np.array(new_points)
         
         return new_points[sorted_idx]
     
+    def AxialCoordinates(self, Points, CenterLinePoints):
+        #Position of the points along the center line: 0 at the base end, 1 at the apex end
+        Axis = CenterLinePoints[-1] - CenterLinePoints[0]
+        return (Points - CenterLinePoints[0]) @ Axis/np.dot(Axis, Axis)
+
+    def RingCenters(self, Points, Axial, CenterLinePoints):
+        #Centers of the myocardium along the center line. Vertices are averaged
+        #over bands at least two mean edge lengths thick, so that every band goes
+        #around the whole wall, and the centers are interpolated in between.
+        #Outside of the myocardium the center line point is used
+        I, J = GetCellEdges(self.Myocardium)
+        MyocardiumPoints = GetPointCoordinates(self.Myocardium)
+        Spacing = np.mean(np.linalg.norm(MyocardiumPoints[I] - MyocardiumPoints[J], axis=1))
+        Length = np.linalg.norm(CenterLinePoints[-1] - CenterLinePoints[0])
+        NBands = int(np.clip(Length/(2*Spacing), 1, len(CenterLinePoints)))
+        Band = np.minimum((Axial*NBands).astype(np.int64), NBands - 1)
+        Counts = np.bincount(Band, minlength=NBands)
+        Filled = Counts > 0
+        BandAxial = np.bincount(Band, weights=Axial, minlength=NBands)[Filled]/Counts[Filled]
+        BandCenters = [np.bincount(Band, weights=Points[:, j], minlength=NBands)[Filled]/Counts[Filled] for j in range(3)]
+
+        def Interpolate(t):
+            return np.column_stack([np.interp(t, BandAxial, BandCenter) for BandCenter in BandCenters])
+
+        LineAxial = np.linspace(0, 1, len(CenterLinePoints))
+        Inside = (LineAxial >= Axial.min()) & (LineAxial <= Axial.max())
+        Center = np.array(CenterLinePoints, dtype=np.float64)
+        Center[Inside] = Interpolate(LineAxial[Inside])
+
+        return Interpolate(Axial), Center
+
+    def RingCrossings(self, Points, Axial, Npoints):
+        #Points where the polyline through Points crosses the planes of the
+        #rings (what cutting it with every ring plane gives), with their ring
+        Ring = Axial*(Npoints - 1)
+        Lower = np.minimum(Ring[:-1], Ring[1:])
+        Upper = np.maximum(Ring[:-1], Ring[1:])
+        First = np.maximum(np.ceil(Lower), 0).astype(np.int64)
+        Last = np.minimum(np.floor(Upper), Npoints - 1).astype(np.int64)
+        Count = np.where(Upper > Lower, np.maximum(Last - First + 1, 0), 0)
+        Segment = np.repeat(np.arange(len(Count)), Count)
+        Rings = np.repeat(First, Count) + np.arange(Count.sum()) - np.repeat(np.cumsum(Count) - Count, Count)
+        Fraction = ((Rings - Ring[Segment])/(Ring[Segment + 1] - Ring[Segment]))[:, None]
+        Crossings = Points[Segment] + Fraction*(Points[Segment + 1] - Points[Segment])
+        Order = np.lexsort((Segment, Rings))
+
+        return Crossings[Order], Rings[Order]
+
+    def SectorSummary(self, Axial, Angle, Arrays, TerritoryProfile):
+        #Mean of the profiles and most common territory over SectorRings rings
+        #(base to apex of the myocardium) times Sectors sectors, all bins gathered at once
+        Height = (Axial - Axial.min())/max(np.ptp(Axial), np.finfo(float).eps)
+        Ring = np.minimum((Height*self.SectorRings).astype(np.int64), self.SectorRings - 1)
+        Sector = np.minimum(((Angle + np.pi)/(2*np.pi)*self.Sectors).astype(np.int64), self.Sectors - 1)
+        Bin = Ring*self.Sectors + Sector
+        NBins = self.SectorRings*self.Sectors
+        Counts = np.bincount(Bin, minlength=NBins)
+        Table = {"Ring": np.repeat(np.arange(self.SectorRings), self.Sectors), "Sector": np.tile(np.arange(self.Sectors), self.SectorRings), "NPoints": Counts}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for (ArrayName, Values) in Arrays.items():
+                Table[ArrayName] = np.bincount(Bin, weights=Values, minlength=NBins)/Counts
+
+        #Count of every (bin, territory) pair, the largest one per bin wins
+        Territories, TerritoryIds = np.unique(TerritoryProfile, return_inverse=True)
+        Pairs = np.bincount(Bin*len(Territories) + TerritoryIds.ravel(), minlength=NBins*len(Territories)).reshape(NBins, -1)
+        Table["Territory"] = np.where(Counts > 0, Territories[Pairs.argmax(axis=1)], np.nan)
+
+        ofile_path = os.path.join(self.OutputFolder, "MyocardiumPolarMap_Sectors.csv")
+        with open(ofile_path, "w") as ofile:
+            ofile.write(",".join(Table.keys()) + "\n")
+            for Row in zip(*Table.values()):
+                ofile.write(",".join(str(Value) for Value in Row) + "\n")
+
     def BullsEye(self):
-        CL_direction, CenterLine = self.DefineMyocardiumCenterLine(self.centeroid_base, self.centeroid_apex, 1000)
+        CL_direction, CenterLine = self.DefineMyocardiumCenterLine(self.centeroid_base, self.centeroid_apex, self.Rings)
         rotation, _ = R.align_vectors([[0, 0, 1]], [CL_direction])
 
         print("- Mapping Myocardium onto a Polar Plot")
@@ -188,75 +247,59 @@ class CreatePolarPlot():
         TerritoryArrayName = "TerritoryProfile"
         WallThicknessArrayName = "WallThickness"
 
-        append_filter = vtk.vtkAppendPolyData()
-        Center = []
-        progress_ = 0
-        for i in range(Npoints):
-            progress_ = PrintProgress(i, Npoints, progress_)
-            
-            point = CenterLine.GetPoint(i)
-            slice_ = self.SliceWPlane(self.Myocardium, point, CL_direction)
-            if slice_.GetNumberOfPoints() == 0:
-                Center.append(point)
-                continue
-
-            MBFProfile = slice_.GetPointData().GetArray(MBFArrayName)
-            TerritoryProfile = slice_.GetPointData().GetArray(TerritoryArrayName)
-            WallThickness = slice_.GetPointData().GetArray(WallThicknessArrayName)
-            pts_np = np.array([slice_.GetPoint(j) for j in range(slice_.GetNumberOfPoints())])
-            center = pts_np.mean(axis=0)
-            Center.append(center)
-            new_coords = []
-            for j in range(slice_.GetNumberOfPoints()):
-                coord_ = slice_.GetPoint(j)
-                aligned_coord_ = rotation.apply(coord_ - center)
-                angle = np.arctan2(aligned_coord_[1], aligned_coord_[0])
-                new_coords.append([R_map[i]*np.cos(angle), R_map[i]*np.sin(angle), 0])
-            
-            slice_MBF = self.CopyProfileToPolyData(slice_, MBFProfile, new_coords, MBFArrayName)
-            slice_MBF_territory = self.AddProfileToPolyData(slice_MBF, TerritoryProfile, TerritoryArrayName)
-            append_filter.AddInputData(self.AddProfileToPolyData(slice_MBF_territory, WallThickness, WallThicknessArrayName))
-        append_filter.Update()
+        #Every vertex goes to the ring of its closest center line point and is
+        #placed at its angle around the center of the myocardium at that height
+        CenterLinePoints = GetPointCoordinates(CenterLine).astype(np.float64)
+        MyocardiumPoints = GetPointCoordinates(self.Myocardium).astype(np.float64)
+        Axial = self.AxialCoordinates(MyocardiumPoints, CenterLinePoints)
+        Inside = (Axial >= 0) & (Axial <= 1)
+        PointCenters, Center = self.RingCenters(MyocardiumPoints[Inside], Axial[Inside], CenterLinePoints)
+        Ring = np.rint(Axial[Inside]*(Npoints - 1)).astype(np.int64)
+        aligned_coords = rotation.apply(MyocardiumPoints[Inside] - PointCenters)
+        angle = np.arctan2(aligned_coords[:, 1], aligned_coords[:, 0])
+        radius = np.asarray(R_map)[Ring]
+        new_coords = np.column_stack((radius*np.cos(angle), radius*np.sin(angle), np.zeros(len(angle))))
+
+        PolarPoints = vtk.vtkPolyData()
+        PolarPoints.SetPoints(vtk.vtkPoints())
+        PolarPoints.GetPoints().SetData(numpy_to_vtk(new_coords, deep=True))
+        Profiles = {}
+        for ArrayName in (MBFArrayName, TerritoryArrayName, WallThicknessArrayName):
+            Profiles[ArrayName] = vtk_to_numpy(self.Myocardium.GetPointData().GetArray(ArrayName))[Inside]
+            Profile = numpy_to_vtk(Profiles[ArrayName].astype(np.float32), deep=True)
+            Profile.SetName(ArrayName)
+            PolarPoints.GetPointData().AddArray(Profile)
 
         print("- Writing Average MBF, Territory, and WallThickness Maps and Regions")
-        PolarMap = self.MeshPolyData(append_filter.GetOutput())
+        PolarMap = self.MeshPolyData(PolarPoints)
 
         WriteVTPFile(os.path.join(self.OutputFolder, "MyocardiumPolarMap.vtp"), PolarMap)
 
+        if self.Sectors > 0:
+            TerritoryProfile = Profiles.pop(TerritoryArrayName)
+            self.SectorSummary(Axial[Inside], angle, Profiles, TerritoryProfile)
+
         print("- Mapping Coronaries Into Polar Plot:")
         args = argparse.Namespace()
         args.InputFolder = self.PathFolder
         Path2Point = ConvertPath2VTP(args)
         for path in Path2Point.filenames:
             VesselCenterline, _ = Path2Point.pth_to_points(path)
-            file_ = Path2Point.points_to_vtp(VesselCenterline)
-            new_points = []
-            arbitrary_points = []
-            for i in range(Npoints):
-                point = CenterLine.GetPoint(i)
-                slice_ = self.SliceWPlane(file_, point, CL_direction)
-            
-                if slice_.GetNumberOfPoints() == 0:
-                    continue
-                for j in range(slice_.GetNumberOfPoints()):
-                    arbitrary_points.append(slice_.GetPoint(j))
-                    centered_point = [
-                        slice_.GetPoint(j)[0] - Center[i][0],
-                        slice_.GetPoint(j)[1] - Center[i][1],
-                        slice_.GetPoint(j)[2] - Center[i][2]
-                    ]
-                    distance = np.linalg.norm(np.array(slice_.GetPoint(j)) - np.array(Center[i]))
-                    
-                    Locator = vtk.vtkPointLocator()
-                    Locator.SetDataSet(self.Myocardium)
-                    Locator.BuildLocator()
-                    closest_point_id = Locator.FindClosestPoint(slice_.GetPoint(j))
-                    surface_point = self.Myocardium.GetPoint(closest_point_id)
-                    distance /= np.linalg.norm(np.array(surface_point) - np.array(Center[i]))
-
-                    alignPoints = rotation.apply(centered_point)
-                    angle = np.arctan2(alignPoints[1], alignPoints[0])
-                    new_points.append([distance*R_map[i]*np.cos(angle), distance*R_map[i]*np.sin(angle), 0])
+            #All the ring planes crossed by the vessel in one pass over its segments
+            VesselPoints = np.asarray(VesselCenterline, dtype=np.float64).reshape(-1, 3)
+            arbitrary_points, slice_ids = self.RingCrossings(VesselPoints, self.AxialCoordinates(VesselPoints, CenterLinePoints), Npoints)
+
+            new_points = np.zeros((0, 3))
+            if len(arbitrary_points) > 0:
+                #The closest myocardium points of all the vessel points in one query
+                centers = np.asarray(Center, dtype=np.float64)[slice_ids]
+                surface_points = MyocardiumPoints[ClosestPointIds(MyocardiumPoints, arbitrary_points)]
+                centered_points = arbitrary_points - centers
+                distance = np.linalg.norm(centered_points, axis=1)/np.linalg.norm(surface_points - centers, axis=1)
+                alignPoints = rotation.apply(centered_points)
+                angle = np.arctan2(alignPoints[:, 1], alignPoints[:, 0])
+                radius = distance*np.asarray(R_map)[slice_ids]
+                new_points = np.column_stack((radius*np.cos(angle), radius*np.sin(angle), np.zeros(len(angle))))
             
             new_points_sorted = self.ReorderCoronaryMapBasedOnCenterLine(arbitrary_points, VesselCenterline, new_points)
             vessel_polydata = Path2Point.points_to_vtp(new_points_sorted)
@@ -277,6 +320,9 @@ if __name__ == "__main__":
     Parser.add_argument("-PathFolder", "--PathFolder", dest= "PathFolder", required= False, type=str, default="Paths")
     Parser.add_argument("-PlotRadius", "--PlotRadius", dest= "PlotRadius", default=12.0, type=float, required= False)
     Parser.add_argument("-Scale", "--Scale", dest= "Scale", default="cm", type=str, required=False)
+    Parser.add_argument("-Rings", "--Rings", dest= "Rings", default=1000, type=int, required=False, help= "Number of rings of the polar map from base to apex")
+    Parser.add_argument("-Sectors", "--Sectors", dest= "Sectors", default=0, type=int, required=False, help= "Also write the average profiles over this many sectors per ring (0: no)")
+    Parser.add_argument("-SectorRings", "--SectorRings", dest= "SectorRings", default=4, type=int, required=False, help= "Number of rings of the sector averages")
     args = Parser.parse_args()
 
     CreatePolarPlot(args).BullsEye()
\ No newline at end of file
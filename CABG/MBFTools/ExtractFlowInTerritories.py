@@ -2,7 +2,9 @@ import os
 import vtk
 import argparse
 import numpy as np
-from utilities import ReadVTUFile, ThresholdInBetween
+import pandas as pd
+from utilities import ReadVTUFile, RemoveBoundaryLayers, GetCellArray, CellBoundingBoxVolumes, CellAverageOfPointArray, CellDataFlow
+from utilities import TerritoryCellLabels, AggregateByLabel, AggregateTerritories, SumOverLabels, GetTerritoryIndex, TerritoryCellIds
 from vtk.util.numpy_support import vtk_to_numpy
 
 class ExtractSubtendedFlow():
@@ -11,53 +13,104 @@ class ExtractSubtendedFlow():
         self.args = args
 
     def ReadMBFFiles(self):
-        self.MBF = ReadVTUFile(args.InputMBF)
-        labels = f"{os.path.splitext(self.args.InputMBF)[0]}_Labels.dat"
+        ExcludeLayers = getattr(self.args, "ExcludeLayers", 0)
+        self.MBF = RemoveBoundaryLayers(ReadVTUFile(self.args.InputMBF), ExcludeLayers)
+        self.TerritoryIndex = GetTerritoryIndex(self.args.InputMBF, self.MBF, ExcludeLayers)
+        #The labels of the territory map, next to it unless given (e.g. when
+        #InputMBF is the output of ImageAnalysisMyocardiumRemoveBoundaryData)
+        labels = getattr(self.args, "InputLabels", None)
+        if labels is None:
+            labels = f"{os.path.splitext(self.args.InputMBF)[0]}_Labels.dat"
         self.Labels = {}
         with open(labels, "r") as ifile:
-            for LINE in ifile:
+            for i, LINE in enumerate(ifile):
+                if i == 0:
+                    continue
                 line = LINE.split()
                 self.Labels[line[1]] = line[0]
 
 
-    def CalculateVoxelFlow(self, Array, voxel, Unit):
-        id_list = voxel.GetPointIds()
-        cell_bounds = voxel.GetBounds()
-        cell_volume = abs(cell_bounds[0] - cell_bounds[1]) * abs(cell_bounds[2] - cell_bounds[3]) * abs(cell_bounds[4] - cell_bounds[5])
-
-        average_cell_mbf = 0
-        for i in range(id_list.GetNumberOfIds()):
-            average_cell_mbf += Array.GetValue(id_list.GetId(i))
-        
+    def CalculateCellFlow(self, Volume, Unit, ArrayName, CellIds=None):
+        #The MBF of a cell is the average over its points
+        CellMBF = CellAverageOfPointArray(Volume, ArrayName, CellIds)
+        CellVolumes = CellBoundingBoxVolumes(Volume, CellIds)
         rho = 1.05
         if Unit == 'mm':
-            return rho*average_cell_mbf/id_list.GetNumberOfIds()*cell_volume/1000/100
+            return rho*CellMBF*CellVolumes/1000/100
         elif Unit == 'cm':
-            return rho*average_cell_mbf/id_list.GetNumberOfIds()*cell_volume/100
+            return rho*CellMBF*CellVolumes/100
 
     def CalculateFlowInVoluem(self, Volume, Unit, ArrayName):
-        MBFScalarArray = Volume.GetPointData().GetArray(ArrayName)
-        NCells = Volume.GetNumberOfCells()
-        Flow = 0
-        for i in range(NCells):
-            voxel = Volume.GetCell(i)
-            Flow += self.CalculateVoxelFlow(MBFScalarArray, voxel, Unit)
-        
-        return Flow
+        return np.sum(self.CalculateCellFlow(Volume, Unit, ArrayName))
     
-    def ExtractSubtendedTerritory(self, TerritoryTag):
-        self.ReadMBFFiles()
-        SubtendedFlow = 0
+    def CollectTerritoryLabels(self, TerritoryTag):
+        TerritoryLabels = []
         self.TerritoryTags = ""
         for (key, item) in self.Labels.items():
             if TerritoryTag in key:
                 self.TerritoryTags += os.path.splitext(key)[0] + "+"
-                territory_ = ThresholdInBetween(self.MBF, "TerritoryMaps", int(item), int(item))
-                SubtendedFlow += self.CalculateFlowInVoluem(territory_, self.args.Unit)
+                TerritoryLabels.append(int(item))
+
+        return TerritoryLabels
+
+    def ExtractSubtendedTerritory(self, TerritoryTag):
+        self.ReadMBFFiles()
+        #Only the cells of the territory are visited, looked up in the index
+        CellIds = TerritoryCellIds(self.TerritoryIndex, self.CollectTerritoryLabels(TerritoryTag))
         
-        return SubtendedFlow
+        return np.sum(self.CalculateCellFlow(self.MBF, self.args.Unit, self.args.ArrayName, CellIds))
     
+    def CollectTerritoryTags(self, TerritoryTag):
+        #"all" stands for every tag found in the centerline names, e.g. L_LAD_1.vtp -> LAD
+        if "all" not in TerritoryTag:
+            return TerritoryTag
+        TerritoryTags = []
+        for key in self.Labels.keys():
+            tag = os.path.splitext(key)[0].split("_")[1]
+            if tag not in TerritoryTags:
+                TerritoryTags.append(tag)
+
+        return TerritoryTags
+
+    def ExtractSubtendedTerritories(self, TerritoryTag):
+        self.ReadMBFFiles()
+        #Flow, volume and MBF of every territory label in one pass over the cells
+        Labels = TerritoryCellLabels(self.MBF, "TerritoryMaps")
+        NumberOfLabels = Labels.max()+1 if len(Labels) > 0 else 0
+        CellVolumes = CellBoundingBoxVolumes(self.MBF)
+        CellFlow = self.CalculateCellFlow(self.MBF, self.args.Unit, self.args.ArrayName)
+        CellMBF = CellAverageOfPointArray(self.MBF, self.args.ArrayName)
+        LabelFlow = AggregateByLabel(Labels, CellFlow, NumberOfLabels)
+        LabelVolume = AggregateByLabel(Labels, CellVolumes, NumberOfLabels)
+        LabelMBFxVolume = AggregateByLabel(Labels, CellMBF*CellVolumes, NumberOfLabels)
+
+        Table = {"TerritoryTag": [], "TerritoryTags": [], "Flow (mL/min)": [], "Volume (mL)": [], "Mean MBF (mL/min/100mL)": []}
+        for tag in self.CollectTerritoryTags(TerritoryTag):
+            TerritoryLabels = self.CollectTerritoryLabels(tag)
+            Volume = SumOverLabels(LabelVolume, TerritoryLabels)
+            Table["TerritoryTag"].append(tag)
+            Table["TerritoryTags"].append(self.TerritoryTags)
+            Table["Flow (mL/min)"].append(SumOverLabels(LabelFlow, TerritoryLabels))
+            Table["Volume (mL)"].append(Volume/1000 if self.args.Unit == 'mm' else Volume)
+            Table["Mean MBF (mL/min/100mL)"].append(SumOverLabels(LabelMBFxVolume, TerritoryLabels)/Volume if Volume > 0 else np.nan)
+
+        return pd.DataFrame(Table)
+
     def main(self):
+        #Several tags (or "all") are aggregated together into one table
+        if len(self.args.TerritoryTag) > 1 or "all" in self.args.TerritoryTag:
+            Table = self.ExtractSubtendedTerritories(self.args.TerritoryTag)
+            print(Table.to_string(index=False))
+            ofile_path = self.args.OutputFile
+            if ofile_path is None:
+                ofile_path = f"./{os.path.splitext(os.path.basename(self.args.InputMBF))[0]}_MBFxVolume.csv"
+            if ofile_path.endswith(".parquet"):
+                Table.to_parquet(ofile_path, index=False)
+            else:
+                Table.to_csv(ofile_path, index=False)
+            return
+
+        self.args.TerritoryTag = self.args.TerritoryTag[0]
         SubtendedFlow = self.ExtractSubtendedTerritory(self.args.TerritoryTag)
         print("Flow = ", int(SubtendedFlow*100)/100, "mL/min")
         ofile_path = f"./{os.path.splitext(os.path.basename(self.args.InputMBF))[0]}_MBFxVolume_{self.args.TerritoryTag}.dat"
@@ -83,38 +136,19 @@ class ExtractSubtendedFlow():
         return PointToCell.GetOutput()
 
     def CalculateCellDataFlow(self, Territory, ArrayName):
-        CellData = Territory.GetCellData()
-        ImageScalars = vtk_to_numpy(CellData.GetArray(ArrayName))
-        NCells = Territory.GetNumberOfCells()
-        TerritoryVolume = 0
-        TerritoryFlow = []
-        for i in range(NCells):
-            cell = Territory.GetCell(i)
-            cell_bounds = cell.GetBounds()
-            cell_volume = abs(cell_bounds[0] - cell_bounds[1]) * abs(cell_bounds[2] - cell_bounds[3]) * abs(cell_bounds[4] - cell_bounds[5])
-            TerritoryFlow.append(ImageScalars[i]*cell_volume)
-            TerritoryVolume += cell_volume
-
-        if self.args.Unit == 'mm':
-            return np.array(TerritoryFlow)/1000/100, TerritoryVolume/1000, NCells, ImageScalars
-        elif self.args.Unit == 'cm':
-            return np.array(TerritoryFlow)/100, TerritoryVolume, NCells, ImageScalars
+        TerritoryFlow, TerritoryVolume, NCells = CellDataFlow(Territory, ArrayName, self.args.Unit)
+        ImageScalars = GetCellArray(Territory, ArrayName)
+
+        return TerritoryFlow, TerritoryVolume, NCells, ImageScalars
 
     def ExtractCellDataSubtendedTerritory(self, MBF, ArrayName):
-        SubtendedFlow = 0
-        self.TerritoryTags = ""
-        NCells = 0
-        TerritoryVolume = 0
-        MBFScalarArray = np.array([])
-        for (key, item) in self.Labels.items():
-            if self.args.TerritoryTag in key:
-                self.TerritoryTags += os.path.splitext(key)[0] + "+"
-                territory_ = self.ThresholdInBetween(MBF, "TerritoryMaps", int(item), int(item))
-                flow_, volume_, nCells, scalararray = self.CalculateCellDataFlow(territory_, ArrayName)
-                SubtendedFlow += np.sum(flow_)
-                NCells += nCells
-                TerritoryVolume += volume_
-                MBFScalarArray = np.append(scalararray, MBFScalarArray)
+        TerritoryLabels = self.CollectTerritoryLabels(self.args.TerritoryTag)
+        Labels = TerritoryCellLabels(MBF, "TerritoryMaps")
+        Aggregate = AggregateTerritories(MBF, ArrayName, self.args.Unit, Labels=Labels)
+        SubtendedFlow = SumOverLabels(Aggregate["Flow"], TerritoryLabels)
+        TerritoryVolume = SumOverLabels(Aggregate["Volume"], TerritoryLabels)
+        NCells = SumOverLabels(Aggregate["NCells"], TerritoryLabels)
+        MBFScalarArray = GetCellArray(MBF, ArrayName)[np.isin(Labels, TerritoryLabels)]
         
         return SubtendedFlow, TerritoryVolume/NCells*1000, TerritoryVolume, MBFScalarArray
 
@@ -122,10 +156,12 @@ class ExtractSubtendedFlow():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-InputMBF", "--InputMBF", dest= "InputMBF", type= str, required= True)
-    #parser.add_argument("-InputLabel", "--InputLabel", dest= "InputLabel", type= str, required= True)
+    parser.add_argument("-InputLabels", "--InputLabels", dest= "InputLabels", type= str, required= False, default= None, help= "Territory labels file (default: <InputMBF>_Labels.dat)")
     parser.add_argument("-ArrayName", "--ArrayName", dest = "ArrayName", type = str, required = False, default = "ImageScalars")
-    parser.add_argument("-TerritoryTag", "--TerritoryTag", type= str, required=True, dest = "TerritoryTag")
+    parser.add_argument("-TerritoryTag", "--TerritoryTag", type= str, required=True, nargs= "+", dest = "TerritoryTag", help= "One or more tags (e.g. LAD LCx), or all")
+    parser.add_argument("-OutputFile", "--OutputFile", type= str, required=False, default= None, dest = "OutputFile", help= "Table written when several tags are given (.csv or .parquet)")
     parser.add_argument("-Unit", "--Unit", type= str, dest= "Unit", default="mm", required=False)
+    parser.add_argument("-ExcludeLayers", "--ExcludeLayers", type= int, dest= "ExcludeLayers", default= 0, required= False, help= "Number of boundary layers (LayerIndex) to leave out of the analysis")
     args = parser.parse_args()
     
     ExtractSubtendedFlow(args).main()
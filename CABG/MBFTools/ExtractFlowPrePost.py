@@ -1,23 +1,43 @@
 import os
 import vtk
 import argparse
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 import seaborn as sns
-import matplotlib.pyplot as plt
-from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
-from utilities import ReadVTUFile
+from matplotlib.artist import setp
+from vtk.util.numpy_support import vtk_to_numpy
+from utilities import ReadVTUFile, RemoveBoundaryLayers, CellDataFlow, GetCellArray, GetTerritoryIndex, TerritoryCellIds, DescribeArray
 from ExtractFlowInTerritories import ExtractSubtendedFlow
+from NormalizeMBFMap import NormalizeArray
+from ReportFigures import FigureReport, PlotFigure, ReportFileName
 
 class ExtractFlowPrePost(ExtractSubtendedFlow):
     def __init__(self, args):
         super().__init__(args)
         self.args = args
+        self.Report = None
 
-    def ReadPrePostFiles(self):
-        self.MBF_A = ReadVTUFile(os.path.join(self.args.InputFolder,self.args.InputMBF))
-        self.MBF_B = ReadVTUFile(os.path.join(f"{self.args.InputFolder[:-1]}B",self.args.InputMBF))
-        self.InputLabels = os.path.join(f"{self.args.InputFolder[:-1]}B",self.args.InputLabels)
+    def __getstate__(self):
+        #The cases are analyzed in worker processes with a copy of self. The
+        #figure report (threads and locks) stays in this process
+        State = self.__dict__.copy()
+        State["Report"] = None
+        return State
+
+    def CaseFolder(self, Case):
+        #The pre-CABG folder ends with "A", the post-CABG folder with "B"
+        return self.args.InputFolder if Case == "A" else f"{self.args.InputFolder[:-1]}B"
+
+    def CaseFileName(self, Case):
+        return os.path.join(self.CaseFolder(Case), self.args.InputMBF)
+
+    def ReadCaseFile(self, Case):
+        ExcludeLayers = getattr(self.args, "ExcludeLayers", 0)
+        InputMBF = self.CaseFileName(Case)
+        MBF = RemoveBoundaryLayers(ReadVTUFile(InputMBF), ExcludeLayers)
+        TerritoryIndex = GetTerritoryIndex(InputMBF, MBF, ExcludeLayers)
+        return MBF, TerritoryIndex
 
     def ReadMBFLabels(self):
         Ischemic_Labels = {}
@@ -43,29 +63,25 @@ class ExtractFlowPrePost(ExtractSubtendedFlow):
         
         return Ischemic_Labels
 
-    def ReadTerritoryMBF(self, MBFMap, MBF_Labels, ArrayName):
+    def ReadTerritoryMBF(self, MBFMap, MBF_Labels, ArrayName, TerritoryIndex):
+        #Every territory is kept as the ids of its cells, looked up in the index.
+        #The labels were averaged into the cells by ConvertPointDataToCellData
+        MBF = GetCellArray(MBFMap, ArrayName)
         MBF_data = {}
         Territories = {}
         for key in MBF_Labels.keys():
-            MBF_data[key] = np.array([])
-            AppendTerritory = vtk.vtkAppendFilter()
-            for i in MBF_Labels[key]:
-                territory_ = self.ThresholdInBetween(MBFMap, "TerritoryMaps", i, i)
-                AppendTerritory.AddInputData(territory_)
-                MBF_ = vtk_to_numpy(territory_.GetCellData().GetArray(ArrayName))
-                MBF_data[key] = np.append(MBF_, MBF_data[key])
-            AppendTerritory.Update()
-            Territories[key] = AppendTerritory.GetOutput()
+            Territories[key] = TerritoryCellIds(TerritoryIndex, MBF_Labels[key], Averaged=True)
+            MBF_data[key] = MBF[Territories[key]]
         
         return MBF_data, Territories
 
-    def CollectFlowData(self, Territories, ArrayName):
-        Flow_Territoris = {k:v for k, v in Territories.items()}
-        Volume_Territories = {k:v for k, v in Territories.items()}
-        Average_Flow = {k:v for k, v in Territories.items()}
+    def CollectFlowData(self, MBF, Territories, ArrayName):
+        Flow_Territoris = {}
+        Volume_Territories = {}
+        Average_Flow = {}
 
         for (key, value) in Territories.items():
-            flow_, territory_volume_, NCell = self.CalculateCellDataFlow(value, ArrayName)
+            flow_, territory_volume_, NCell = self.CalculateCellDataFlow(MBF, ArrayName, value)
             Flow_Territoris[key] = flow_
             Volume_Territories[key] = territory_volume_
             Average_Flow[key] = flow_/NCell
@@ -73,15 +89,6 @@ class ExtractFlowPrePost(ExtractSubtendedFlow):
             
         return Flow_Territoris, Volume_Territories, Average_Flow, voxel_size
     
-    def ThresholdInBetween(self, Volume, arrayname, value1, value2):
-        Threshold=vtk.vtkThreshold()
-        Threshold.SetInputData(Volume)
-        Threshold.SetLowerThreshold(value1)
-        Threshold.SetUpperThreshold(value2)
-        Threshold.SetInputArrayToProcess(0,0,0,vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS,arrayname)
-        Threshold.Update()
-        return Threshold.GetOutput()
-    
     def ConvertPointDataToCellData(self, pointdata):
         PointToCell = vtk.vtkPointDataToCellData()
         PointToCell.SetInputData(pointdata)
@@ -89,31 +96,19 @@ class ExtractFlowPrePost(ExtractSubtendedFlow):
 
         return PointToCell.GetOutput()
 
-    def CalculateCellDataFlow(self, Territory, ArrayName):
-        CellData = Territory.GetCellData()
-        ImageScalars = vtk_to_numpy(CellData.GetArray(ArrayName))
-        NCells = Territory.GetNumberOfCells()
-        TerritoryVolume = 0
-        TerritoryFlow = []
-        for i in range(NCells):
-            cell = Territory.GetCell(i)
-            cell_bounds = cell.GetBounds()
-            cell_volume = abs(cell_bounds[0] - cell_bounds[1]) * abs(cell_bounds[2] - cell_bounds[3]) * abs(cell_bounds[4] - cell_bounds[5])
-            TerritoryFlow.append(ImageScalars[i]*cell_volume)
-            TerritoryVolume += cell_volume
-
-        if self.args.Unit == 'mm':
-            return np.array(TerritoryFlow)/1000/100, TerritoryVolume/1000, NCells
-        elif self.args.Unit == 'cm':
-            return np.array(TerritoryFlow)/100, TerritoryVolume, NCells
-
-
-    def BarPlot(self, BarData, ylabel):
+    def CalculateCellDataFlow(self, Territory, ArrayName, CellIds=None):
+        return CellDataFlow(Territory, ArrayName, self.args.Unit, CellIds)
+
+
+    def BarPlot(self, BarData, ylabel, Name="BarPlot"):
+        PlotFigure(self.Report, "BarPlot", ReportFileName(self.args.InputFolder, Name), (16, 10), self.DrawBarPlot, BarData, ylabel)
+
+    def DrawBarPlot(self, fig, BarData, ylabel):
         df = pd.DataFrame(BarData)
-        plt.figure(figsize=(16, 10))
         pastel_colors = sns.color_palette("pastel")
         selected_colors = [pastel_colors[3], pastel_colors[2]]
-        ax = sns.barplot(data=df, x="Territory", y="Value", hue="Time", palette=selected_colors)
+        ax = fig.add_subplot()
+        sns.barplot(data=df, x="Territory", y="Value", hue="Time", palette=selected_colors, ax=ax)
         for p in ax.patches:
             height = p.get_height()
             if not pd.isna(height):  # Check for missing values
@@ -126,121 +121,119 @@ class ExtractFlowPrePost(ExtractSubtendedFlow):
                     fontsize=12
                 )
 
-        plt.ylabel(ylabel, fontsize = 15)
-        plt.xticks(rotation=45, ha="right", fontsize = 15)
-        plt.tight_layout()
-        plt.show()
+        ax.set_ylabel(ylabel, fontsize = 15)
+        setp(ax.get_xticklabels(), rotation=45, ha="right", fontsize = 15)
+        fig.tight_layout()
 
     def BoxPlot(self, BoxData):
         pass
 
-    def TerritoryStatistics(self, Territories,ArrayName):
+    def TerritoryStatistics(self, MBF_data):
         MBFStatistics = {}
-        for (key, item) in Territories.items():
-            item_ = vtk_to_numpy(item.GetCellData().GetArray(ArrayName))
-            MBFStatistics[key] = {
-            "Mean": np.mean(item_),
-            "std": np.std(item_),
-            "Median": np.median(item_),
-            "IQR": np.percentile(item_, 75) - np.percentile(item_, 25)
-            }
+        for (key, item_) in MBF_data.items():
+            MBFStatistics[key] = DescribeArray(item_)
 
         return MBFStatistics
     
     def MyocardiumStatistics(self, MBF, ArrayName):
-        Array = vtk_to_numpy(MBF.GetCellData().GetArray(ArrayName))
-        Myocardium_Statistics  = {
-            "Mean": np.mean(Array),
-            "std": np.std(Array),
-            "Median": np.median(Array),
-            "IQR": np.percentile(Array, 75) - np.percentile(Array, 25)
-        }
-        return Myocardium_Statistics
+        return DescribeArray(GetCellArray(MBF, ArrayName))
 
     
-    def Normalize(self, MBF, ArrayName):
-        ScalarArray = MBF.GetCellData().GetArray(ArrayName)
-        per_75th = np.percentile(vtk_to_numpy(ScalarArray), 75)
-        IndexMBFArray = ScalarArray/per_75th
-        IndexMBF = numpy_to_vtk(IndexMBFArray)
-        IndexMBF.SetName("IndexMBF")
-        MBF.GetCellData().AddArray(IndexMBF)
+    def Normalize(self, MBF, ArrayName, FileName=None):
+        #FileName is the file MBF was read from, to use the percentile cache
+        CacheTag = f"CellData:ExcludeLayers={getattr(self.args, 'ExcludeLayers', 0)}"
+        per_75th = NormalizeArray(MBF.GetCellData(), ArrayName, 75, FileName, CacheTag)
 
         return per_75th, MBF
     
+    def FindScalarArray(self, MBF):
+        for i in range(MBF.GetCellData().GetNumberOfArrays()):
+            arrayname_ = MBF.GetCellData().GetArrayName(i)
+            if "scalars" in arrayname_.lower():
+                ScalarArray = arrayname_
+
+        return ScalarArray
+
+    def AnalyzeCase(self, Case, MBFLabels):
+        #Everything that only depends on one case. Only NumPy arrays and
+        #dictionaries are returned, so the case can run in a worker process
+        MBF, TerritoryIndex = self.ReadCaseFile(Case)
+        MBF = self.ConvertPointDataToCellData(MBF)
+        ScalarArray = self.FindScalarArray(MBF)
+
+        Results = {}
+        MBF_data, Territories = self.ReadTerritoryMBF(MBF, MBFLabels, ScalarArray, TerritoryIndex)
+        Results["Flow"], Results["Volume"], Results["AverageFlow"], Results["VoxelSize"] = self.CollectFlowData(MBF, Territories, ScalarArray)
+        Results["MBFStat"] = self.TerritoryStatistics(MBF_data)
+
+        Results["perc75"], IndexMBF = self.Normalize(MBF, ScalarArray, self.CaseFileName(Case))
+        IndexMBF_data, _ = self.ReadTerritoryMBF(IndexMBF, MBFLabels, "IndexMBF", TerritoryIndex)
+        Results["IndexMBFStat"] = self.TerritoryStatistics(IndexMBF_data)
+        Results["IndexFlow"], _, Results["AverageIndexFlow"], _ = self.CollectFlowData(IndexMBF, Territories, "IndexMBF")
+
+        Results["stats"] = self.MyocardiumStatistics(MBF, ScalarArray)
+        Results["index_stats"] = self.MyocardiumStatistics(IndexMBF, 'IndexMBF')
+
+        return Results
+
     def main(self):
-        self.ReadPrePostFiles()
+        self.InputLabels = os.path.join(self.CaseFolder("B"), self.args.InputLabels)
         MBFLabels = self.ReadMBFLabels()
-        self.MBF_A = self.ConvertPointDataToCellData(self.MBF_A)
-        self.MBF_B = self.ConvertPointDataToCellData(self.MBF_B)
 
-        for i in range(self.MBF_A.GetCellData().GetNumberOfArrays()):
-            arrayname_ = self.MBF_A.GetCellData().GetArrayName(i)
-            if "scalars" in arrayname_.lower():
-                ScalarArray_A = arrayname_
-        #ScalarArray_A = "ImageScalars"
-        for i in range(self.MBF_B.GetCellData().GetNumberOfArrays()):
-            arrayname_ = self.MBF_A.GetCellData().GetArrayName(i)
-            if "scalars" in arrayname_.lower():
-                ScalarArray_B = arrayname_
-        #ScalarArray_B = "scalars"
-        
-        _, Territories_A = self.ReadTerritoryMBF(self.MBF_A, MBFLabels, ScalarArray_A)
-        _, Territories_B = self.ReadTerritoryMBF(self.MBF_B, MBFLabels, ScalarArray_B)
-        Flow_A, Volume_A, AverageFlow_A, VoxelSize_A = self.CollectFlowData(Territories_A, ScalarArray_A)
-        Flow_B, Volume_B, AverageFlow_B, VoxelSize_B = self.CollectFlowData(Territories_B, ScalarArray_B)
+        #With -ReportFolder the figures are saved in the background. The report
+        #is opened first, so it gets ready while the cases are analyzed. A
+        #report set by the caller is left open
+        Report = self.Report
+        if Report is None and getattr(self.args, "ReportFolder", None) is not None:
+            self.Report = FigureReport(self.args.ReportFolder)
+
+        #The pre- and post-CABG cases are independent until they are compared
+        if self.args.Parallel:
+            with Pool(2) as pool:
+                Results_A, Results_B = pool.starmap(self.AnalyzeCase, [("A", MBFLabels), ("B", MBFLabels)])
+        else:
+            Results_A = self.AnalyzeCase("A", MBFLabels)
+            Results_B = self.AnalyzeCase("B", MBFLabels)
 
         Bardata = {"Territory": [], "Time": [], "Value": []}
-        for key in Flow_A.keys():
+        for key in Results_A["Flow"].keys():
             Bardata["Territory"].extend([key, key])
             Bardata["Time"].extend(["PreCABG", "PostCABG"])
-            Bardata["Value"].extend([np.sum(Flow_A[key]), np.sum(Flow_B[key])])
+            Bardata["Value"].extend([np.sum(Results_A["Flow"][key]), np.sum(Results_B["Flow"][key])])
 
         #self.BarPlot(Bardata)
 
         Bardata = {"Territory": [], "Time": [], "Value": []}
-        for key in Flow_A.keys():
+        for key in Results_A["Flow"].keys():
             Bardata["Territory"].extend([key, key])
             Bardata["Time"].extend(["PreCABG", "PostCABG"])
-            Bardata["Value"].extend([np.sum(AverageFlow_A[key])*1000, np.sum(AverageFlow_B[key])*1000])
+            Bardata["Value"].extend([np.sum(Results_A["AverageFlow"][key])*1000, np.sum(Results_B["AverageFlow"][key])*1000])
 
         #self.BarPlot(Bardata)
-        
-        MBFStat_A = self.TerritoryStatistics(Territories_A, ScalarArray_A)
-        MBFStat_B = self.TerritoryStatistics(Territories_B, ScalarArray_B)
-
-        perc75_A, IndexMBF_A = self.Normalize(self.MBF_A, ScalarArray_A)
-        perc75_B, IndexMBF_B = self.Normalize(self.MBF_B, ScalarArray_B)
-        _, ITerritories_A = self.ReadTerritoryMBF(IndexMBF_A, MBFLabels, "IndexMBF")
-        _, ITerritories_B = self.ReadTerritoryMBF(IndexMBF_B, MBFLabels, "IndexMBF")
-
-        IndexMBFStat_A = self.TerritoryStatistics(ITerritories_A, "IndexMBF")
-        IndexMBFStat_B = self.TerritoryStatistics(ITerritories_B, "IndexMBF")
-
-        IndexFlow_A, _, AverageIndexFlow_A, _ = self.CollectFlowData(ITerritories_A, "IndexMBF")
-        IndexFlow_B, _, AverageIndexFlow_B, _ = self.CollectFlowData(ITerritories_B, "IndexMBF")
 
         Bardata = {"Territory": [], "Time": [], "Value": []}
-        for key in IndexFlow_A.keys():
+        for key in Results_A["IndexFlow"].keys():
             Bardata["Territory"].extend([key, key])
             Bardata["Time"].extend(["PreCABG", "PostCABG"])
-            Bardata["Value"].extend([np.sum(IndexFlow_A[key])*1000, np.sum(IndexFlow_B[key])*1000])
+            Bardata["Value"].extend([np.sum(Results_A["IndexFlow"][key])*1000, np.sum(Results_B["IndexFlow"][key])*1000])
 
-        self.BarPlot(Bardata, "relative Flow ($mm^3$)")
+        self.BarPlot(Bardata, "relative Flow ($mm^3$)", "RelativeFlow")
 
         Bardata = {"Territory": [], "Time": [], "Value": []}
-        for key in IndexFlow_A.keys():
+        for key in Results_A["IndexFlow"].keys():
             Bardata["Territory"].extend([key, key])
             Bardata["Time"].extend(["PreCABG", "PostCABG"])
-            Bardata["Value"].extend([np.sum(AverageIndexFlow_A[key]), np.sum(AverageIndexFlow_B[key])])
+            Bardata["Value"].extend([np.sum(Results_A["AverageIndexFlow"][key]), np.sum(Results_B["AverageIndexFlow"][key])])
 
         #self.BarPlot(Bardata, "Average relative Flow (\u00b5/min/Voxel)")
 
-
-        stats_A = self.MyocardiumStatistics(self.MBF_A, ScalarArray_A)
-        stats_B = self.MyocardiumStatistics(self.MBF_B, ScalarArray_B)
-        index_stats_A = self.MyocardiumStatistics(IndexMBF_A, 'IndexMBF')
-        index_stats_B = self.MyocardiumStatistics(IndexMBF_B, 'IndexMBF')
+        stats_A, stats_B = Results_A["stats"], Results_B["stats"]
+        index_stats_A, index_stats_B = Results_A["index_stats"], Results_B["index_stats"]
+        MBFStat_A, MBFStat_B = Results_A["MBFStat"], Results_B["MBFStat"]
+        IndexMBFStat_A, IndexMBFStat_B = Results_A["IndexMBFStat"], Results_B["IndexMBFStat"]
+        Volume_A, Volume_B = Results_A["Volume"], Results_B["Volume"]
+        VoxelSize_A, VoxelSize_B = Results_A["VoxelSize"], Results_B["VoxelSize"]
+        perc75_A, perc75_B = Results_A["perc75"], Results_B["perc75"]
 
         Bardata2 = {"Territory": [], "Time": [], "Value": []}
         for key in IndexMBFStat_A.keys():
@@ -248,7 +241,7 @@ class ExtractFlowPrePost(ExtractSubtendedFlow):
             Bardata2["Time"].extend(["PreCABG", "PostCABG"])
             Bardata2["Value"].extend([IndexMBFStat_A[key]['Mean'], IndexMBFStat_B[key]['Mean']])
 
-        self.BarPlot(Bardata2, "Average Index MBF")
+        self.BarPlot(Bardata2, "Average Index MBF", "IndexMBF")
 
         opath = os.path.join(self.args.InputFolder, "PrePostStatistics.dat")
         with open(opath, 'w') as ofile:
@@ -276,6 +269,10 @@ class ExtractFlowPrePost(ExtractSubtendedFlow):
                 ofile.writelines(f"Median, {np.median(Flow_A[key])}, {np.median(Flow_B[key])}, {np.median(IndexFlow_A[key])}, {np.median(IndexFlow_B[key])}\n")
                 ofile.writelines(f"IQR, {np.percentile(Flow_A[key], 75) - np.percentile(Flow_A[key], 25)}, {np.percentile(Flow_B[key], 75) - np.percentile(Flow_B[key], 25)}, {np.percentile(IndexFlow_A[key], 75) - np.percentile(IndexFlow_A[key], 25)}, {np.percentile(IndexFlow_B[key], 75) - np.percentile(IndexFlow_B[key], 25)}\n")"""
 
+        if Report is None and self.Report is not None:
+            self.Report.Close()
+            self.Report = None
+
 
 
 if __name__ == "__main__":
@@ -286,6 +283,9 @@ if __name__ == "__main__":
     parser.add_argument("-ArrayName", "--ArrayName", dest = "ArrayName", type = int, required = False, default = 0)
     parser.add_argument("-TerritoryTag", "--TerritoryTag", type= str, required=True, nargs= "+", dest = "TerritoryTag")
     parser.add_argument("-Unit", "--Unit", type= str, dest= "Unit", default="cm", required=False)
+    parser.add_argument("-ExcludeLayers", "--ExcludeLayers", type= int, dest= "ExcludeLayers", default= 0, required= False, help= "Number of boundary layers (LayerIndex) to leave out of the analysis")
+    parser.add_argument("-Parallel", "--Parallel", action= "store_true", default= False, required= False, dest= "Parallel", help= "Analyze the pre- and post-CABG cases in two worker processes")
+    parser.add_argument("-ReportFolder", "--ReportFolder", type= str, default= None, required= False, dest= "ReportFolder", help= "Save the figures to this folder instead of showing them")
     args = parser.parse_args()
 
     ExtractFlowPrePost(args).main()
\ No newline at end of file
@@ -10,6 +10,10 @@ import os
 from glob import glob
 from scipy.spatial import distance as DISTANCE
 import argparse
+from scipy.sparse import coo_matrix
+from vtk.util.numpy_support import numpy_to_vtk
+from scipy.spatial import cKDTree
+from utilities import GetPointCoordinates, GetPointArray, GetCellEdges
 
 class ImageAnalysisMyocardiumRemoveBoundaryData():
 	def __init__(self,Args):
@@ -19,7 +23,7 @@ class ImageAnalysisMyocardiumRemoveBoundaryData():
 		if self.Args.OutputFileName is None:
 			InputFileNameStripped=self.Args.InputFileName.split("/")[-1]
 			OutputFolder =self.Args.InputFileName.replace(InputFileNameStripped,"")
-			OutputFileName=OutputFolder+"MyocardiumRemoveBoundaryData"
+			OutputFileName=OutputFolder+"MyocardiumRemoveBoundaryData.vtu"
 			self.Args.OutputFileName=OutputFileName
 
 	def main(self):
@@ -27,95 +31,74 @@ class ImageAnalysisMyocardiumRemoveBoundaryData():
 		print ("--- Reading Left Ventricle Myocardial Blood Flow Data and Territory Maps: %s"%self.Args.InputFileName)
 		Volume=self.Read_Vtu(self.Args.InputFileName)
 
-		#Now extract all of the surface mesh nodes fromt the volumetric data
-		print ("--- Extracting the Surface Coordinates from the Volumetric Mesh")
-		SurfaceCoords=self.ExtractSurfaceCoordinates(Volume)
-
-		#Now Find the distance from the each of the volumetric node to the surface coordinate
-		print ("--- Scrap off N=%d layers from the Volume"%self.Args.Layers)
-		ThresholdArray=[False]*Volume.GetNumberOfPoints()
-		ThresholdArray=self.ProximityToSurface(Volume,SurfaceCoords,ThresholdArray,0)
+		#Peel the mesh from its surface inwards along the cell connectivity and
+		#measure how far every node is from the wall. Both are stored as arrays,
+		#so masking any number of layers is a threshold on LayerIndex later on
+		print ("--- Computing the layer index of every node from the surface")
+		SurfaceIds=self.GetSurfacePointIds(Volume)
+		LayerIndex=self.ComputeLayerIndex(Volume,SurfaceIds)
+		LayerIndexArray=numpy_to_vtk(LayerIndex,deep=False,array_type=vtk.VTK_INT)
+		LayerIndexArray.SetName("LayerIndex")
+		Volume.GetPointData().AddArray(LayerIndexArray)
+
+		print ("--- Computing the distance of every node to the wall")
+		WallDistanceArray=numpy_to_vtk(self.ComputeWallDistance(Volume,SurfaceIds),deep=True)
+		WallDistanceArray.SetName("WallDistance")
+		Volume.GetPointData().AddArray(WallDistanceArray)
+
+		print ("--- Writing File: %s"%self.Args.OutputFileName)
+		self.WriteOutput(self.Args.OutputFileName,Volume)
+
+		#Volumes with the layers scrapped off are only written on request
+		if self.Args.WriteLayers:
+			print ("--- Scrap off N=%d layers from the Volume"%self.Args.Layers)
+			OutputFilePrefix=os.path.splitext(self.Args.OutputFileName)[0]
+			for Counter in range(int(self.Args.Layers)):
+				ThresholdArray=(LayerIndex>=0)&(LayerIndex<=Counter)
+				Volume=self.ThresholdVolume(Volume,ThresholdArray)
+
+				#Save the current volume with "i"th layer scrapped off
+				print ("--- Writing File: %s"%OutputFilePrefix+"_layer_%d.vtu"%Counter)
+				self.WriteOutput(OutputFilePrefix+"_layer_%d.vtu"%Counter,Volume)
+			print ("Finished Removing %d Layers from the Myocardium walls"%self.Args.Layers)
 		
 	def ThresholdVolume(self,Volume,ThresholdArray):
-		N=Volume.GetNumberOfPoints()
-		for i in range(N):
-			if ThresholdArray[i] is True:
-				Volume.GetPointData().GetArray(self.Args.ArrayName).SetValue(i,0)
+		#Write straight into the VTK buffer through a NumPy view
+		Scalars=GetPointArray(Volume,self.Args.ArrayName)
+		Scalars[np.array(ThresholdArray,dtype=bool)]=0
+		Volume.GetPointData().GetArray(self.Args.ArrayName).Modified()
 		return Volume	
 
-	def ProximityToSurface(self,Volume,SurfaceCoords,ThresholdArray,Counter):
-		if Counter==self.Args.Layers:
-			print ("Finished Removing %d Layers from the Myocardium walls"%self.Args.Layers)
-			return ThresholdArray
- 
-		Np_vol =Volume.GetNumberOfPoints()
-		Np_surf=len(SurfaceCoords[0])
-		progress_old=-1	
-		
-		#Create a list of Surface Nodes to first check overlap with Volume node
-		#Then check the distance. This may be faster 
-		SurfaceCoordsX_aslist=np.ndarray.tolist(SurfaceCoords[0])
-		SurfaceCoordsY_aslist=np.ndarray.tolist(SurfaceCoords[1])
-		SurfaceCoordsZ_aslist=np.ndarray.tolist(SurfaceCoords[2])
-		SurfaceCoords_aslist=[SurfaceCoordsX_aslist,SurfaceCoordsY_aslist,SurfaceCoordsZ_aslist]
-
-		#Loop over all of the volumetric nodes
-		for i in range(Np_vol):
-			#print the progress so far
-			progress_=self.PRINT_PROGRESS(i,Np_vol,progress_old)
-			progress_old=progress_
-		
-			#Loop over the volume points and shed the layer	
-			volume_coord_=Volume.GetPoint(i)
-			if (ThresholdArray[i] is False) and (volume_coord_[0] in SurfaceCoords_aslist[0]) and (volume_coord_[1] in SurfaceCoords_aslist[1]) and (volume_coord_[2] in SurfaceCoords_aslist[2]):
-				ThresholdArray[i]=True
-				SurfaceCoords_aslist[0].remove(volume_coord_[0])
-				SurfaceCoords_aslist[1].remove(volume_coord_[1])
-				SurfaceCoords_aslist[2].remove(volume_coord_[2])
-
-                
-		#Now Make all of the scalar values close to the surface 0.
-		Volume=self.ThresholdVolume(Volume,ThresholdArray)
-		self.WriteOutput(self.Args.OutputFileName,Volume)	
-		
-		#Get New surface Coordinates
-		Threshold=vtk.vtkThreshold()
-		Threshold.SetInputData(Volume)
-		Threshold.ThresholdByUpper(1)
-		Threshold.SetInputArrayToProcess(0, 0, 0,"vtkDataObject::FIELD_ASSOCIATION_POINTS",self.Args.ArrayName)
-		Threshold.Update()
-		Threshold=Threshold.GetOutput()
-		SurfaceCoords=self.ExtractSurfaceCoordinates(Threshold)
-		
-		#Save the current volume with "i"th layer scrapped off
-		print ("--- Writing File: %s"%self.Args.OutputFileName+"_layer_%d.vtu"%Counter)
-		self.WriteOutput(self.Args.OutputFileName+"_layer_%d.vtu"%Counter,Volume)
-	
-		#Repeat this in a loop until layers removed			
-		Counter+=1
-		self.ProximityToSurface(Volume,SurfaceCoords,ThresholdArray,Counter)
-
+	def ComputeWallDistance(self,Volume,SurfaceIds):
+		#Straight-line distance from every node to the closest surface node
+		Coords=GetPointCoordinates(Volume)
+		WallDistance,_=cKDTree(Coords[SurfaceIds]).query(Coords,k=1,workers=-1)
+		return WallDistance
 
-	def ExtractSurfaceCoordinates(self,Volume):
-		#Get the Surface File
+	def ComputeLayerIndex(self,Volume,SurfaceIds):
+		#Breadth-first peeling over the point adjacency of the cells. The
+		#surface nodes are layer 0, their unvisited neighbours are layer 1, ...
+		N=Volume.GetNumberOfPoints()
+		I,J=GetCellEdges(Volume)
+		Adjacency=coo_matrix((np.ones(2*len(I),dtype=np.int8),(np.concatenate((I,J)),np.concatenate((J,I)))),shape=(N,N)).tocsr()
+
+		LayerIndex=np.full(N,-1,dtype=np.int32)
+		Frontier=SurfaceIds
+		Layer=0
+		while len(Frontier)>0:
+			LayerIndex[Frontier]=Layer
+			#All of the neighbours of the frontier that have not been visited yet
+			Neighbours=Adjacency[Frontier].indices
+			Frontier=np.unique(Neighbours[LayerIndex[Neighbours]<0])
+			Layer+=1
+		print ("--- Found %d layers between the surface and the mid-wall"%Layer)
+		return LayerIndex
+
+	def GetSurfacePointIds(self,Volume):
+		#Ids of the volume nodes that lie on the outer surface
 		Surface=self.GetSurface(Volume)
+		return np.unique(GetPointArray(Surface,"vtkOriginalPointIds"))
 
-		#Get the Number of Points
-		N=Surface.GetNumberOfPoints()
-		
-		#Loop over all of the points and extract the coordinates
-		SurfaceCoordsX=np.zeros(N)
-		SurfaceCoordsY=np.zeros(N)
-		SurfaceCoordsZ=np.zeros(N)
-		for i in range(N):
-			surface_coords_=Surface.GetPoint(i)[:]
-			SurfaceCoordsX[i]=surface_coords_[0]	
-			SurfaceCoordsY[i]=surface_coords_[1]	
-			SurfaceCoordsZ[i]=surface_coords_[2]	
-
-		return [SurfaceCoordsX,SurfaceCoordsY,SurfaceCoordsZ]
-
-        
 	def Read_Vtu(self,filename):
 		reader=vtk.vtkXMLUnstructuredGridReader()
 		reader.SetFileName(filename)
@@ -128,27 +111,26 @@ class ImageAnalysisMyocardiumRemoveBoundaryData():
 		Volume.SetInputData(data)
 		Volume.Update()
  
-	def PRINT_PROGRESS(self,i,N,progress_old):
-		progress_=(int((float(i)/N*100+0.5)))
-		if progress_%10==0 and progress_%10!=progress_old: print ("    Progress: %d%%"%progress_)
-		return progress_%10
-
 	def GetSurface(self,Volume):
 		Surface=vtk.vtkDataSetSurfaceFilter()
 		Surface.SetInputData(Volume)
+		Surface.PassThroughPointIdsOn()
 		Surface.Update()
 		Surface=Surface.GetOutput()
 		return Surface
 
 if __name__=="__main__":
         #Description
-	parser = argparse.ArgumentParser(description="This script will scrap over the MBF vales from the interior and exterior edges.")
+	parser = argparse.ArgumentParser(description="This script will compute the depth of every node from the interior and exterior edges (LayerIndex and WallDistance), and optionally scrap over the MBF vales close to the edges.")
 
         #Input filename of the perfusion map
 	parser.add_argument('-ifile', '--InputFileName', type=str, required=True, dest="InputFileName",help="Volumetric Mesh that contains the Myocardial Blood Flow Data and Territory Maps")
 
 	#Option to strip off one endo- and one epi-cardial element
-	parser.add_argument('-Layers', '--Layers', type=float, required=True, default=1, dest="Layers", help="The Number of Layers to Shed of the Myocardium")	
+	parser.add_argument('-Layers', '--Layers', type=float, required=False, default=1, dest="Layers", help="The Number of Layers to Shed of the Myocardium")	
+
+	#Option to write one volume per scrapped layer
+	parser.add_argument('-WriteLayers', '--WriteLayers', action="store_true", required=False, default=False, dest="WriteLayers", help="Also write a volume with MBF set to zero for each of the first N layers")
 
         #Array Name of the Data
 	parser.add_argument('-arrayname', '--ArrayName', type=str, required=False,default="ImageScalars", dest="ArrayName",help="The name of the array containing the MBF values")
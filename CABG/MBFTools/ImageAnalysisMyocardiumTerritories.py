@@ -2,11 +2,66 @@ import vtk
 import numpy as np
 import scipy as sp
 import os
+import sys
 from glob import glob
 from scipy.spatial import distance as DISTANCE
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.ndimage import distance_transform_edt
 import argparse
+import time
+from multiprocessing import Pool, util, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from utilities import *
 
+#Arrays shared with the territory worker processes
+TerritoryWorker={}
+
+def CopyToSharedMemory(Array):
+	Array=np.ascontiguousarray(Array)
+	Block=SharedMemory(create=True,size=max(Array.nbytes,1))
+	np.ndarray(Array.shape,dtype=Array.dtype,buffer=Block.buf)[:]=Array
+	return Block,(Block.name,Array.shape,Array.dtype.str)
+
+def AttachSharedMemory(Spec):
+	#The segment belongs to the parent, which unlinks it. Attaching must not
+	#register it with the resource tracker: the tracker would report it as
+	#leaked or unlink it again, and unregistering afterwards would also drop
+	#the registration of the parent when both use the same tracker
+	Name,Shape,DType=Spec
+	if sys.version_info>=(3,13):
+		Block=SharedMemory(name=Name,track=False)
+	else:
+		Register=resource_tracker.register
+		resource_tracker.register=lambda *args: None
+		try:
+			Block=SharedMemory(name=Name)
+		finally:
+			resource_tracker.register=Register
+	return Block,np.ndarray(Shape,dtype=DType,buffer=Block.buf)
+
+def InitTerritoryWorker(CoordsSpec,PointsSpec,TagsSpec,LabelsSpec,DistancesSpec):
+	#Attach to the shared arrays and build the centerline tree once per worker
+	for Key,Spec in zip(["Coords","Points","Tags","Labels","Distances"],[CoordsSpec,PointsSpec,TagsSpec,LabelsSpec,DistancesSpec]):
+		TerritoryWorker[Key+"Block"],TerritoryWorker[Key]=AttachSharedMemory(Spec)
+	TerritoryWorker["Tree"]=cKDTree(TerritoryWorker["Points"])
+	util.Finalize(None,CloseTerritoryWorker,exitpriority=10)
+
+def CloseTerritoryWorker():
+	#The arrays and the tree use the buffers, they go before the handles are closed
+	Blocks=[TerritoryWorker[Key] for Key in TerritoryWorker if Key.endswith("Block")]
+	TerritoryWorker.clear()
+	for Block in Blocks:
+		Block.close()
+
+def LabelTerritoryChunk(Bounds):
+	Start,Stop=Bounds
+	Distances,PointIds=TerritoryWorker["Tree"].query(TerritoryWorker["Coords"][Start:Stop],k=1,workers=1)
+	TerritoryWorker["Labels"][Start:Stop]=TerritoryWorker["Tags"][PointIds]
+	TerritoryWorker["Distances"][Start:Stop]=Distances
+	return Stop-Start
+
 class ImageAnalysisMyocardiumCoronaryTerritories():
 	def __init__(self,Args):
 		#Input argumenets
@@ -17,7 +72,8 @@ class ImageAnalysisMyocardiumCoronaryTerritories():
 				self.Args.OutputFileName = f"./{self.Args.InputFileName.split('/')[-1].split('.')[0]}_Territories.vtu"
 			else:
 				self.Args.OutputFileName="MBF_Territories.vtu"
-			self.Args.OutputFilename2=self.Args.OutputFileName.replace(".vtu","_Labels.dat")
+		self.Args.OutputFilename2=self.Args.OutputFileName.replace(".vtu","_Labels.dat")
+		self.Args.OutputFilename3=self.Args.OutputFileName.replace(".vtu","_Fingerprints.dat")
 
 		#Coronary Centerline Files
 		LADFiles        =sorted(glob("%s/L_LAD_*.vtp"%self.Args.VesselSurfaces))
@@ -42,10 +98,18 @@ class ImageAnalysisMyocardiumCoronaryTerritories():
 		#Get the areas for all of the surface caps
 		#Centroids=self.Get_Centroids(self.CenterlineFileNamesPaths,self.CenterlineFileNames)
 
+		#Only update the nodes affected by edited centerlines if possible
+		if self.Args.Incremental and self.Can_Update_Territories():
+			self.Update_Territories()
+			return
+
                 #Read the vtu file
 		print ("--- Reading Left Ventricle Myocardial Blood Flow Data: %s"%self.Args.InputFileName)
 		if   self.Args.InputFileName[-4:]==".vtk":
 			VentricleMesh=ReadVTKFile(self.Args.InputFileName)   #Read a VTK volume stack
+			if self.Args.GridNative:
+				self.Image_Territories(VentricleMesh)
+				return
 			VentricleMesh=ThresholdByUpper(VentricleMesh,self.Args.ArrayName,1) #unstruct grid 
 		elif self.Args.InputFileName[-4:]==".vtu":
 			VentricleMesh=ReadVTUFile(self.Args.InputFileName) #Read a VTU unstruct grid
@@ -73,79 +137,349 @@ class ImageAnalysisMyocardiumCoronaryTerritories():
 		
 		#For each LV node, find the shortest distance to the CL
 		print ("--- Getting the shortest distance for each Ventricle Node to closest centerline")
-		ClosestCenterLines=self.Get_Shortest_Distance(CenterlineCoordinates,VentricleCoordinates)	
+		StartTime=time.time()
+		if self.Args.AssignmentMode=="Geodesic":
+			TerritoryLabels,ClosestDistances=self.Get_Geodesic_Distance(CenterlineCoordinates,VentricleMesh,VentricleCoordinates)
+		elif self.Args.Workers>1:
+			TerritoryLabels,ClosestDistances=self.Get_Shortest_Distance_Parallel(CenterlineCoordinates,VentricleCoordinates)
+		else:
+			TerritoryLabels,ClosestDistances=self.Get_Shortest_Distance(CenterlineCoordinates,VentricleCoordinates)	
+		ElapsedTime=max(time.time()-StartTime,1e-9)
 		
 		#Now write the data with a new territory division
 		print ("--- Writing the territory maps")
-		self.Write_Territories(VentricleMesh,ClosestCenterLines)
+		self.Write_Territories(VentricleMesh,TerritoryLabels,ClosestDistances)
+		self.Write_Labels()
+		#Geodesic labelling always runs in this process
+		Workers=self.Args.Workers if self.Args.AssignmentMode=="Euclidean" and self.Args.Workers>1 else 1
+		print ("--- Labelled %d nodes in %.2f s (%.0f nodes/s, %d worker(s))"%(len(TerritoryLabels),ElapsedTime,len(TerritoryLabels)/ElapsedTime,Workers))
 
-	def Write_Territories(self,LV_mesh,Closest_CL):
-		#Create New Array in LV mesh with CL names
-		territories=vtk.vtkIntArray()
-		territories.SetNumberOfComponents(1)
+	def Write_Territories(self,LV_mesh,TerritoryLabels,TerritoryDistances):
+		#Attach the label array to the LV mesh without copying it
+		territories=numpy_to_vtk(np.ascontiguousarray(TerritoryLabels,dtype=np.int32),deep=False,array_type=vtk.VTK_INT)
 		territories.SetName("TerritoryMaps")
-		N=LV_mesh.GetNumberOfPoints()
-		for i in range(N):
-			index=self.CenterlineFileNames.index(Closest_CL[i])
-			territories.InsertNextValue(index)
                 
 		LV_mesh.GetPointData().AddArray(territories)
+
+		#Keep the distance to the owning centerline for incremental updates
+		distances=numpy_to_vtk(np.ascontiguousarray(TerritoryDistances,dtype=np.float64),deep=False)
+		distances.SetName("TerritoryDistance")
+		LV_mesh.GetPointData().AddArray(distances)
+		self.Remove_Fingerprints()
 		writer=vtk.vtkXMLUnstructuredGridWriter()
 		writer.SetInputData(LV_mesh)
-		writer.SetFileName(self.Args.OutputFileName)
-		writer.Update()
+		writer.SetFileName(self.Args.OutputFileName+".tmp")
+		if writer.Write()!=1:
+			print ("--- Could not write the territory maps: %s"%self.Args.OutputFileName)
+			print ("Exiting...")
+			exit(1)
+		os.replace(self.Args.OutputFileName+".tmp",self.Args.OutputFileName)
 			
 	
+	def Image_Territories(self,Image):
+		#Label the myocardial voxels directly on the image lattice: rasterize
+		#the centerlines into the grid and take the nearest centerline voxel
+		#of every voxel from a single Euclidean distance transform
+		print ("--- Reading Centerline Files")
+		CenterlineCoordinates=self.Read_CL_Coords(self.CenterlineFileNamesPaths)
+
+		print ("--- Labelling the myocardial voxels with a Euclidean distance transform")
+		StartTime=time.time()
+		Dims=np.array(Image.GetDimensions())
+		Origin=np.array(Image.GetOrigin())
+		Spacing=np.array(Image.GetSpacing())
+		Myocardium=(GetPointArray(Image,self.Args.ArrayName)>=1).reshape(Dims[::-1])
+		if not np.any(Myocardium):
+			print ("--- No voxel of %s has %s>=1, there is no myocardium to label"%(self.Args.InputFileName,self.Args.ArrayName))
+			print ("Exiting...")
+			exit(1)
+
+		#Voxel (i,j,k) of every centerline point. Points that fall in the same
+		#voxel are resolved in favour of the last centerline. Points outside of
+		#the image have no voxel and are left out
+		CL_points,CL_tags=self.Get_Centerline_Points(CenterlineCoordinates)
+		CL_index=np.rint((CL_points-Origin)/Spacing).astype(np.int64)
+		Inside=np.all((CL_index>=0)&(CL_index<Dims),axis=1)
+		if not np.all(Inside):
+			print ("--- %d centerline points are outside of the image and are not used"%np.sum(~Inside))
+		if not np.any(Inside):
+			print ("--- No centerline point is inside of the image")
+			print ("Exiting...")
+			exit(1)
+		CL_index,CL_tags=CL_index[Inside],CL_tags[Inside]
+
+		#Only transform the box that holds the myocardium and the centerlines.
+		#The centerlines run on the epicardium, so this is about the bounding
+		#box of the myocardium. The transform needs ~24 bytes per voxel of the
+		#box (feature image, distances and the int32 index of the nearest
+		#centerline voxel along each axis)
+		MyocardiumIndex=np.argwhere(Myocardium)[:,::-1]
+		Lower=np.minimum(MyocardiumIndex.min(axis=0),CL_index.min(axis=0))
+		Upper=np.maximum(MyocardiumIndex.max(axis=0),CL_index.max(axis=0))+1
+		del MyocardiumIndex
+		Box=(slice(Lower[2],Upper[2]),slice(Lower[1],Upper[1]),slice(Lower[0],Upper[0]))
+		print ("--- Distance transform of a %dx%dx%d box (about %.0f MB)"%(tuple(Upper-Lower)+(np.prod(Upper-Lower)*24/1024.**2,)))
+		Features=np.full(Upper[::-1]-Lower[::-1],-1,dtype=np.int32)
+		Features[tuple((CL_index-Lower)[:,::-1].T)]=CL_tags
+		Distances,Nearest=distance_transform_edt(Features<0,sampling=Spacing[::-1],return_indices=True)
+
+		Labels=np.full(Dims[::-1],-1,dtype=np.int32)
+		Labels[Box]=Features[tuple(Nearest)]
+		Labels[~Myocardium]=-1
+		TerritoryDistances=np.zeros(Dims[::-1])
+		TerritoryDistances[Box]=Distances
+		TerritoryDistances[~Myocardium]=0
+		del Nearest,Distances,Features
+		ElapsedTime=max(time.time()-StartTime,1e-9)
+
+		#Store the labels on the image and write it out
+		territories=numpy_to_vtk(Labels.ravel(),deep=False,array_type=vtk.VTK_INT)
+		territories.SetName("TerritoryMaps")
+		Image.GetPointData().AddArray(territories)
+		distances=numpy_to_vtk(TerritoryDistances.ravel(),deep=False)
+		distances.SetName("TerritoryDistance")
+		Image.GetPointData().AddArray(distances)
+		ImageFileName=self.Args.OutputFileName.replace(".vtu",".vti")
+		print ("--- Writing the territory label image: %s"%ImageFileName)
+		self.Remove_Fingerprints()
+		WriteVTIFile(ImageFileName,Image)
+
+		if self.Args.WriteVTU:
+			print ("--- Writing the thresholded territory maps: %s"%self.Args.OutputFileName)
+			WriteVTUFile(self.Args.OutputFileName,ThresholdByUpper(Image,self.Args.ArrayName,1))
+		self.Write_Labels()
+		print ("--- Labelled %d voxels in %.2f s (%.0f voxels/s)"%(np.sum(Myocardium),ElapsedTime,np.sum(Myocardium)/ElapsedTime))
+
+	def Get_Centerline_Points(self,CL_coords):
+		#Stack all of the centerline points and tag each one with the label
+		#of the centerline it belongs to
+		CL_names=list(CL_coords.keys())
+		CL_points=np.concatenate([CL_coords[Key] for Key in CL_names],axis=0)
+		CL_ids=[self.CenterlineFileNames.index(Key) for Key in CL_names]
+		CL_tags=np.concatenate([np.full(len(CL_coords[Key]),CL_ids[j],dtype=np.int32) for j,Key in enumerate(CL_names)])
+		return CL_points,CL_tags
+
 	def Get_Shortest_Distance(self,CL_coords,LV_coords):
-		#For each Node, Loop over all of the centerlines
+		#Build a single KD-tree over all of the centerline points, so one
+		#nearest-neighbour query per node gives both the territory and its distance
+		CL_points,CL_tags=self.Get_Centerline_Points(CL_coords)
+		Tree=cKDTree(CL_points)
+
+		#Query all of the LV nodes at once using every available core
+		Distances,PointIds=Tree.query(LV_coords,k=1,workers=-1)
+		return CL_tags[PointIds],Distances
+
+	def Get_Shortest_Distance_Parallel(self,CL_coords,LV_coords):
+		#Same query as Get_Shortest_Distance, but the nodes are split into
+		#chunks and labelled by a pool of processes. All arrays live in shared
+		#memory so nothing but the chunk bounds is pickled
+		CL_points,CL_tags=self.Get_Centerline_Points(CL_coords)
 		N=len(LV_coords)
-		Closest_CL=[]
-		count_p=0.05
-		progress_old=-1
-		for i,LV_coord in enumerate(LV_coords):
-			progress_=self.PRINT_PROGRESS(i,N,progress_old)
-			progress_old=progress_
-			distance={}
-			#Loop over all of the centerlines
-			for Key in CL_coords.keys():
-				distance[Key]=np.min(DISTANCE.cdist(CL_coords[Key],[LV_coords[i]]))
-			#Store the Centerline that is closest to the point
-			Closest_CL.append(min(distance,key=distance.get))
-		return Closest_CL	
+		Blocks=[]
+		try:
+			Specs=[]
+			for Array in [np.asarray(LV_coords,dtype=np.float64),np.asarray(CL_points,dtype=np.float64),CL_tags,np.zeros(N,dtype=np.int32),np.zeros(N,dtype=np.float64)]:
+				Block,Spec=CopyToSharedMemory(Array)
+				Blocks.append(Block)
+				Specs.append(Spec)
+
+			ChunkSize=max(1,int(np.ceil(N/(self.Args.Workers*8.))))
+			Chunks=[(Start,min(Start+ChunkSize,N)) for Start in range(0,N,ChunkSize)]
+			with Pool(self.Args.Workers,initializer=InitTerritoryWorker,initargs=Specs) as WorkerPool:
+				Done=0
+				progress_old=-1
+				for NDone in WorkerPool.imap_unordered(LabelTerritoryChunk,Chunks):
+					Done+=NDone
+					progress_old=PrintProgress(Done-1,N,progress_old)
+				#Let the workers exit on their own so that they close their handles
+				WorkerPool.close()
+				WorkerPool.join()
+
+			Labels=np.ndarray((N,),dtype=np.int32,buffer=Blocks[3].buf).copy()
+			Distances=np.ndarray((N,),dtype=np.float64,buffer=Blocks[4].buf).copy()
+		finally:
+			for Block in Blocks:
+				Block.close()
+				Block.unlink()
+		return Labels,Distances
+
+	def Get_Geodesic_Distance(self,CL_coords,LV_mesh,LV_coords):
+		#Path distances through the tissue: build a sparse graph from the mesh
+		#connectivity, seed it at the nodes nearest to each centerline and run
+		#one multi-source Dijkstra sweep that labels every node with its seed
+		print ("--- Building the myocardium graph")
+		N=len(LV_coords)
+		I,J=GetCellEdges(LV_mesh)
+		Weights=np.linalg.norm(LV_coords[I].astype(np.float64)-LV_coords[J],axis=1)
+		Graph=coo_matrix((Weights,(I,J)),shape=(N,N)).tocsr()
+
+		#Seed nodes: the mesh node closest to every centerline point. If a node
+		#is claimed by several centerlines, the closest centerline point wins
+		CL_points,CL_tags=self.Get_Centerline_Points(CL_coords)
+		SeedDistances,SeedNodes=cKDTree(LV_coords).query(CL_points,k=1,workers=-1)
+		Order=np.argsort(SeedDistances,kind="stable")
+		SeedNodes,FirstIds=np.unique(SeedNodes[Order],return_index=True)
+		SeedLabels=CL_tags[Order][FirstIds]
+
+		print ("--- Running the multi-source shortest path from %d seed nodes"%len(SeedNodes))
+		Distances,_,Sources=dijkstra(Graph,directed=False,indices=SeedNodes,min_only=True,return_predecessors=True)
+		NodeLabels=np.full(N,-1,dtype=np.int32)
+		NodeLabels[SeedNodes]=SeedLabels
+		Labels=np.full(N,-1,dtype=np.int32)
+		Reached=Sources>=0
+		Labels[Reached]=NodeLabels[Sources[Reached]]
+
+		#Pieces of the mesh that are not connected to any seed fall back to
+		#the straight-line assignment
+		if not np.all(Reached):
+			print ("--- %d nodes are not connected to any centerline, using Euclidean distance"%np.sum(~Reached))
+			Labels_,Distances_=self.Get_Shortest_Distance(CL_coords,LV_coords[~Reached])
+			Labels[~Reached]=Labels_
+			Distances[~Reached]=Distances_
+		return Labels,Distances
 
 	def Read_CL_Coords(self,filenames):
 		CL_coords={}
-		print ("--- Writing Territory Labels to %s"%self.Args.OutputFilename2)
-		outfile=open(self.Args.OutputFilename2,'w')
-		outfile.write("TerritoryLabel CenterlineName\n")
-		counter=0
 		for filename in filenames:
 			filename_short=filename.split("/")[-1]
 			reader=vtk.vtkXMLPolyDataReader()
 			reader.SetFileName(filename)
 			reader.Update()
 			CL_data=reader.GetOutput()
-			N=CL_data.GetNumberOfPoints()
-			points_=np.zeros(shape=(N,3))
-			for i in range(N):
-				points_[i]=CL_data.GetPoint(i)	
-			CL_coords[filename_short]=points_
-			outfile.write("%d %s\n"%(counter,filename.split("/")[-1]))
-			counter+=1 
-		outfile.close()
+			CL_coords[filename_short]=GetPointCoordinates(CL_data)
 		return CL_coords	
 
+	def Write_Labels(self):
+		#Written once the territories are in place, each file through a
+		#temporary file, so a run that stops early never leaves labels or
+		#fingerprints that describe territories which were not written
+		print ("--- Writing Territory Labels to %s"%self.Args.OutputFilename2)
+		outfile=open(self.Args.OutputFilename2+".tmp",'w')
+		outfile.write("TerritoryLabel CenterlineName\n")
+		for counter,filename in enumerate(self.CenterlineFileNames):
+			outfile.write("%d %s\n"%(counter,filename))
+		outfile.close()
+		os.replace(self.Args.OutputFilename2+".tmp",self.Args.OutputFilename2)
+
+		#Store the settings, the stamp of the input mesh and a fingerprint of
+		#every centerline file to detect edits on reruns
+		outfile=open(self.Args.OutputFilename3+".tmp",'w')
+		for Key,Value in self.Territory_Settings().items():
+			outfile.write("%s %s\n"%(Key,Value))
+		outfile.write("CenterlineName Fingerprint\n")
+		for filename,filepath in zip(self.CenterlineFileNames,self.CenterlineFileNamesPaths):
+			outfile.write("%s %s\n"%(filename,FileFingerprint(filepath)))
+		outfile.close()
+		os.replace(self.Args.OutputFilename3+".tmp",self.Args.OutputFilename3)
+
+	def Remove_Fingerprints(self):
+		#The fingerprints of the previous run no longer describe the output
+		#once it is overwritten, they are written again by Write_Labels
+		if os.path.isfile(self.Args.OutputFilename3):
+			os.remove(self.Args.OutputFilename3)
+
+	def Territory_Settings(self):
+		#Everything besides the centerlines that the territories depend on
+		return {"AssignmentMode":self.Args.AssignmentMode,
+			"InputMesh":"%d-%d"%FileStamp(self.Args.InputFileName),
+			"ArrayName":self.Args.ArrayName,
+			"GridNative":str(self.Args.GridNative)}
+
+	def Read_Fingerprints(self):
+		Settings={}
+		Fingerprints={}
+		infile=open(self.Args.OutputFilename3,'r')
+		for LINE in infile:
+			line=LINE.split()
+			if line[0]=="CenterlineName": break
+			Settings[line[0]]=" ".join(line[1:])
+		for LINE in infile:
+			line=LINE.split()
+			Fingerprints[line[0]]=line[1]
+		infile.close()
+		return Settings,Fingerprints
+
+	def Read_Labels(self):
+		Labels={}
+		infile=open(self.Args.OutputFilename2,'r')
+		infile.readline()
+		for LINE in infile:
+			line=LINE.split()
+			Labels[int(line[0])]=line[1]
+		infile.close()
+		return Labels
+
+	def Can_Update_Territories(self):
+		#The previous run has to be a complete Euclidean run of the same mesh
+		for filename in [self.Args.OutputFileName,self.Args.OutputFilename2,self.Args.OutputFilename3]:
+			if not os.path.isfile(filename):
+				print ("--- %s not found, computing all of the territories"%filename)
+				return False
+		if self.Args.GridNative:
+			print ("--- Incremental updates are not supported for the grid-native path, computing all of the territories")
+			return False
+		Settings=self.Read_Fingerprints()[0]
+		if self.Args.AssignmentMode!="Euclidean" or Settings.get("AssignmentMode")!="Euclidean":
+			print ("--- Incremental updates are only supported for Euclidean territories, computing all of the territories")
+			return False
+		if Settings!=self.Territory_Settings():
+			print ("--- The input mesh, the array name or the grid-native setting changed since the last run, computing all of the territories")
+			return False
+		return True
+
+	def Update_Territories(self):
+		#Find the centerlines that were edited, added or removed since the last run
+		print ("--- Reading previous territories: %s"%self.Args.OutputFileName)
+		_,OldFingerprints=self.Read_Fingerprints()
+		OldLabels=self.Read_Labels()
+		Fingerprints={filename:FileFingerprint(filepath) for filename,filepath in zip(self.CenterlineFileNames,self.CenterlineFileNamesPaths)}
+		Changed=[filename for filename in self.CenterlineFileNames if OldFingerprints.get(filename)!=Fingerprints[filename]]
+		Removed=[filename for filename in OldFingerprints.keys() if filename not in Fingerprints]
+		for filename in Changed: print ("    Edited or added: %s"%filename)
+		for filename in Removed: print ("    Removed: %s"%filename)
+		if len(Changed)==0 and len(Removed)==0:
+			print ("--- Centerlines are unchanged, territories are up to date")
+			return
+
+		VentricleMesh=ReadVTUFile(self.Args.OutputFileName)
+		VentricleCoordinates=GetPointCoordinates(VentricleMesh)
+		PreviousLabels=GetPointArray(VentricleMesh,"TerritoryMaps")
+		Distances=GetPointArray(VentricleMesh,"TerritoryDistance").astype(np.float64)
+
+		#Carry over the owners that still exist unchanged, under their new label
+		OldToNew=np.full(max(OldLabels.keys())+2,-1,dtype=np.int32)
+		for OldLabel,filename in OldLabels.items():
+			if filename in Fingerprints and filename not in Changed:
+				OldToNew[OldLabel]=self.CenterlineFileNames.index(filename)
+		Labels=OldToNew[PreviousLabels]
+
+		#Nodes owned by an edited or removed centerline are recomputed from scratch
+		Stale=Labels<0
+		print ("--- Recomputing %d nodes whose centerline was edited or removed"%np.sum(Stale))
+		if np.any(Stale):
+			CenterlineCoordinates=self.Read_CL_Coords(self.CenterlineFileNamesPaths)
+			Labels[Stale],Distances[Stale]=self.Get_Shortest_Distance(CenterlineCoordinates,VentricleCoordinates[Stale])
+		else:
+			ChangedPaths=[self.CenterlineFileNamesPaths[self.CenterlineFileNames.index(filename)] for filename in Changed]
+			CenterlineCoordinates=self.Read_CL_Coords(ChangedPaths)
+
+		#All other nodes only move if an edited or added centerline is now closer
+		if len(Changed)>0:
+			ChangedCoordinates={filename:CenterlineCoordinates[filename] for filename in Changed}
+			NewLabels,NewDistances=self.Get_Shortest_Distance(ChangedCoordinates,VentricleCoordinates)
+			Closer=NewDistances<Distances
+			Labels[Closer]=NewLabels[Closer]
+			Distances[Closer]=NewDistances[Closer]
+			print ("--- %d nodes moved to an edited or added centerline"%np.sum(Closer))
+
+		print ("--- Writing the territory maps")
+		self.Write_Territories(VentricleMesh,Labels,Distances)
+		self.Write_Labels()
+
 	def Get_Point_Data(self,LV_mesh):
 		print ("--- Getting LV Coordinates and MBF")
-		N=LV_mesh.GetNumberOfPoints()	
-		Coords=np.zeros(shape=(N,3))
-		imageScalars=np.zeros(N)
-		for i in range(N):
-			coord_=LV_mesh.GetPoint(i)
-			Coords[i,0]=coord_[0]
-			Coords[i,1]=coord_[1]
-			Coords[i,2]=coord_[2]
-			imageScalars[i]=LV_mesh.GetPointData().GetArray(self.Args.ArrayName).GetValue(i)
+		Coords=GetPointCoordinates(LV_mesh)
+		imageScalars=GetPointArray(LV_mesh,self.Args.ArrayName)
 		return Coords,imageScalars	
 
 	def Read_Vtu(self,filename):
@@ -203,6 +537,24 @@ if __name__=="__main__":
         #Output argumenets
 	parser.add_argument('-OutputFileName', '--OutputFileName', type=str, required=False, dest="OutputFileName",help="The output filename of the volumetric data with territories")
 
+	#Straight-line or through-the-tissue distance to the centerlines
+	parser.add_argument('-AssignmentMode', '--AssignmentMode', type=str, required=False, default="Euclidean", choices=["Euclidean","Geodesic"], dest="AssignmentMode",help="Euclidean assigns nodes to the nearest centerline, Geodesic uses shortest paths through the myocardium mesh.")
+
+	#Options for .vtk image input
+	parser.add_argument('-GridNative', '--GridNative', action="store_true", required=False, default=False, dest="GridNative",help="For .vtk images, label the voxels on the image grid with a distance transform and write a label image (.vti). Euclidean only, in one process.")
+	parser.add_argument('-WriteVTU', '--WriteVTU', action="store_true", required=False, default=False, dest="WriteVTU",help="With -GridNative, also write the thresholded unstructured grid with the territory maps.")
+
+	#Reuse the previous output and only update nodes affected by edited centerlines
+	parser.add_argument('-Incremental', '--Incremental', action="store_true", required=False, default=False, dest="Incremental",help="Only recompute the nodes affected by centerline files that changed since the last run.")
+
+	#Number of processes used to label the nodes
+	parser.add_argument('-Workers', '--Workers', type=int, required=False, default=1, dest="Workers",help="Number of worker processes for the territory assignment (1 runs serially).")
+
 	args=parser.parse_args()
+	#The grid-native labelling is a Euclidean distance transform in one process
+	if args.GridNative and args.AssignmentMode=="Geodesic":
+		parser.error("-GridNative can not be used with -AssignmentMode Geodesic")
+	if args.GridNative and args.Workers>1:
+		parser.error("-GridNative can not be used with -Workers larger than 1")
 	ImageAnalysisMyocardiumCoronaryTerritories(args).main()
 
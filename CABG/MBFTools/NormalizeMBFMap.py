@@ -1,28 +1,82 @@
 import os
+import vtk
+import json
 import numpy as np
 import argparse
-from utilities import ReadVTUFile, WriteVTUFile
-from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+from utilities import ReadVTUFile, WriteVTUFile, FileStamp, Quantiles
+from vtk.util.numpy_support import vtk_to_numpy
+
+#The reference percentile of every normalized file is cached beside it in
+#<name>_Normalization.json, keyed by the size and modification time of the file
+
+def NormalizationCacheFileName(FileName):
+    return f"{os.path.splitext(FileName)[0]}_Normalization.json"
+
+def ReadCachedPercentile(FileName, Key):
+    CacheFileName = NormalizationCacheFileName(FileName)
+    if not os.path.exists(CacheFileName):
+        return None
+    with open(CacheFileName, "r") as ifile:
+        return json.load(ifile).get(Key)
+
+def WriteCachedPercentile(FileName, Key, Value):
+    #Entries of an older version of the file are dropped
+    CacheFileName = NormalizationCacheFileName(FileName)
+    Cache = {}
+    if os.path.exists(CacheFileName):
+        with open(CacheFileName, "r") as ifile:
+            Cache = json.load(ifile)
+    Fingerprint = Key.split(":")[0]
+    Cache = {k: v for k, v in Cache.items() if k.split(":")[0] == Fingerprint}
+    Cache[Key] = float(Value)
+    try:
+        with open(CacheFileName, "w") as ofile:
+            json.dump(Cache, ofile, indent=1)
+    except OSError:
+        print(f"--- Could not write the normalization cache: {CacheFileName}")
+
+def NormalizeArray(Attributes, ArrayName, Percentile=75, FileName=None, CacheTag=""):
+    #Adds IndexMBF = MBF/(Percentile of MBF) to the point or cell data. The
+    #percentile comes from one selection (no full sort) or from the cache of
+    #FileName; CacheTag tells apart data derived differently from that file
+    Values = vtk_to_numpy(Attributes.GetArray(ArrayName))
+    Reference = None
+    if FileName is not None:
+        Size, MTime = FileStamp(FileName)
+        Key = f"{Size}-{MTime}:{Attributes.GetArray(ArrayName).GetName()}:{Percentile}:{CacheTag}"
+        Reference = ReadCachedPercentile(FileName, Key)
+    if Reference is None:
+        Reference = Quantiles(Values, [Percentile/100.])[0]
+        if FileName is not None:
+            WriteCachedPercentile(FileName, Key, Reference)
+    if np.issubdtype(Values.dtype, np.floating):
+        Reference = Values.dtype.type(Reference)
+
+    #Divide straight into the buffer of a float32 VTK array
+    IndexMBF = vtk.vtkFloatArray()
+    IndexMBF.SetName("IndexMBF")
+    IndexMBF.SetNumberOfTuples(len(Values))
+    np.divide(Values, Reference, out=vtk_to_numpy(IndexMBF), casting="unsafe")
+    Attributes.AddArray(IndexMBF)
+
+    return Reference
 
 class MBFNormalization():
     def __init__(self, args):
         super().__init__()
         self.args = args
 
-    def Normalize(self, MBF):
-        ImageScalars = MBF.GetPointData().GetArray(self.args.ArrayName)
-        per_75th = np.percentile(vtk_to_numpy(ImageScalars), 75)
-        IndexMBFArray = ImageScalars/per_75th
-        IndexMBF = numpy_to_vtk(IndexMBFArray)
-        IndexMBF.SetName("IndexMBF")
-        MBF.GetPointData().AddArray(IndexMBF)
+    def Normalize(self, MBF, FileName=None):
+        #FileName is the file MBF was read from, to use the percentile cache
+        CacheTag = f"PointData:ExcludeLayers={getattr(self.args, 'ExcludeLayers', 0)}"
+        per_75th = NormalizeArray(MBF.GetPointData(), self.args.ArrayName, 75, FileName, CacheTag)
 
         return per_75th, MBF
 
 
     def main(self):
         MBF = ReadVTUFile(self.args.InputMBFMap)
-        _, IndexMBF = self.Normalize(MBF)
+        _, IndexMBF = self.Normalize(MBF, self.args.InputMBFMap)
         OPath = f"{os.path.splitext(self.args.InputMBFMap)[0]}_Normalized.vtu"
         WriteVTUFile(OPath, IndexMBF)
 
@@ -32,5 +86,5 @@ if __name__ == "__main__":
     parser.add_argument("-InputMBFMap", "--InputMBFMap", dest = "InputMBFMap", type = str, required = True)
     parser.add_argument("-ArrayName", "--ArrayName", dest = "ArrayName", type = int, required = False, default= 0)
     args = parser.parse_args()
-    
-    MBFNormalization(args).main()
\ No newline at end of file
+
+    MBFNormalization(args).main()
@@ -1,42 +1,62 @@
 import os
 import vtk
 import argparse
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 import seaborn as sns
-import matplotlib.pyplot as plt
+from matplotlib.artist import setp
 from vtk.util.numpy_support import vtk_to_numpy
-from utilities import ReadVTUFile, ThresholdInBetween, ExtractSurface
+from utilities import ReadVTUFile, ExtractSurface, RemoveBoundaryLayers, GetPointArray
+from utilities import GetTerritoryIndex, TerritoryCellIds, TerritoryPointIds, ExtractCellsByIds
+from utilities import CellVolumes, TerritoryCellLabels, AggregateByLabel, SumOverLabels, SurfaceProperties
 from NormalizeMBFMap import MBFNormalization
+from ReportFigures import FigureReport, PlotFigure, ReportFileName
 
 class PrePostMBFMap(MBFNormalization):
     def __init__(self, args):
         args.InputMBFMap = f"{args.InputFolder}/{args.InputMBF}"
         args.ArrayName = 0
         self.args = args
+        self.Report = None
         super().__init__(args)
-        self.MBF_A = ReadVTUFile(f"{args.InputFolder}/{args.InputMBF}")
-        self.MBF_B = ReadVTUFile(f"{args.InputFolder[:-1]}B/{args.InputMBF}")
         self.InputLabels = f"{args.InputFolder[:-1]}B/{args.InputLabels}"
 
-    def ReadTerritoryMBF(self, MBFMap, MBF_Labels, ArrayName = 0):
+    def __getstate__(self):
+        #The cases are analyzed in worker processes with a copy of self. The
+        #figure report (threads and locks) stays in this process
+        State = self.__dict__.copy()
+        State["Report"] = None
+        return State
+
+    def CaseFolder(self, Case):
+        #The pre-CABG folder ends with "A", the post-CABG folder with "B"
+        return self.args.InputFolder if Case == "A" else f"{self.args.InputFolder[:-1]}B"
+
+    def CaseFileName(self, Case):
+        return f"{self.CaseFolder(Case)}/{self.args.InputMBF}"
+
+    def ReadCaseFile(self, Case):
+        ExcludeLayers = getattr(self.args, "ExcludeLayers", 0)
+        InputMBF = self.CaseFileName(Case)
+        MBF = RemoveBoundaryLayers(ReadVTUFile(InputMBF), ExcludeLayers)
+        TerritoryIndex = GetTerritoryIndex(InputMBF, MBF, ExcludeLayers)
+        return MBF, TerritoryIndex
+
+    def ReadTerritoryMBF(self, MBFMap, MBF_Labels, TerritoryIndex, ArrayName = 0):
+        #Every territory is kept as the ids of its cells, looked up in the index,
+        #and only extracted when its geometry is needed
+        MBF = GetPointArray(MBFMap, ArrayName)
         MBF_data = {}
         Territories = {}
         for key in MBF_Labels.keys():
-            MBF_data[key] = np.array([])
-            AppendTerritory = vtk.vtkAppendFilter()
-            for i in MBF_Labels[key]:
-                territory_ = ThresholdInBetween(MBFMap, "TerritoryMaps", i, i)
-                AppendTerritory.AddInputData(territory_)
-                AppendTerritory.Update()
-                MBF_ = vtk_to_numpy(territory_.GetPointData().GetArray(ArrayName))
-                MBF_data[key] = np.append(MBF_, MBF_data[key])
-            Territories[key] = AppendTerritory.GetOutput()
+            Territories[key] = TerritoryCellIds(TerritoryIndex, MBF_Labels[key])
+            MBF_data[key] = MBF[TerritoryPointIds(TerritoryIndex, MBF_Labels[key])]
         
         return MBF_data, Territories
 
 
-    def PlotBox(self, MBF_Labels, MBF_data_pre, MBF_data_post, ylabel = "MBF (ml/min/100g)"):
+    def PlotBox(self, MBF_Labels, MBF_data_pre, MBF_data_post, ylabel = "MBF (ml/min/100g)", Name = "MBF"):
         color_list = ['aquamarine', 'sandybrown', 'palegreen', 'lightcyan', 'thistle', 'lavender', 'salmon', 'peachpuff']
         
         Labels = []
@@ -50,8 +70,11 @@ class PrePostMBFMap(MBFNormalization):
                 IndexMBF.append(MBF_data_post[key])
                 colors.append(color_list[i])
                 colors.append(color_list[i])
-            
-        _, ax = plt.subplots()
+
+        PlotFigure(self.Report, "BoxPlot", ReportFileName(self.args.InputFolder, Name), (6.4, 4.8), self.DrawBoxPlot, Labels, IndexMBF, colors, ylabel)
+
+    def DrawBoxPlot(self, fig, Labels, IndexMBF, colors, ylabel):
+        ax = fig.add_subplot()
         ax.set_ylabel(ylabel, fontdict={'size':20})
         bplot = ax.boxplot(IndexMBF, patch_artist=True, labels=Labels, showfliers= False)
 
@@ -62,9 +85,8 @@ class PrePostMBFMap(MBFNormalization):
             median.set_color('darkblue')
             median.set_linewidth(2)
 
-        plt.setp(ax.get_xticklabels(), rotation=45, ha='right', fontsize = 13)
-        plt.tight_layout()
-        plt.show()
+        setp(ax.get_xticklabels(), rotation=45, ha='right', fontsize = 13)
+        fig.tight_layout()
 
     def ReadMBFLabels(self):
         MBF_Labels = {"LAD": [], "LCx":[], "Intermedius":[], "Diag1":[], "Diag2":[], "PDA":[], "PL":[]}
@@ -77,50 +99,91 @@ class PrePostMBFMap(MBFNormalization):
 
         return MBF_Labels
 
+    def AnalyzeCase(self, Case, MBF_Labels):
+        #Everything that only depends on one case. Only NumPy arrays and
+        #dictionaries are returned, so the case can run in a worker process
+        MBF, TerritoryIndex = self.ReadCaseFile(Case)
+        Results = {}
+        Results["MBF_data"], Territories = self.ReadTerritoryMBF(MBF, MBF_Labels, TerritoryIndex)
+
+        _, IndexMBF = super().Normalize(MBF, self.CaseFileName(Case))
+        Results["IndexMBF_data"], _ = self.ReadTerritoryMBF(IndexMBF, MBF_Labels, TerritoryIndex, "IndexMBF")
+
+        Results["Volume_MBF"], Results["Volume_data"] = self.ComputeTerritoryVolume(MBF, MBF_Labels)
+        if getattr(self.args, "SurfaceVolume", False):
+            Results["SurfaceVolume_MBF"] = self.ComputeVolume(ExtractSurface(MBF))
+            Results["SurfaceVolume_data"] = self.ComputeSurfaceTerritoryVolume(MBF, Territories)
+
+        return Results
+
     def main(self):
         MBF_Labels = self.ReadMBFLabels()
-        MBF_data_A, Territories_A = self.ReadTerritoryMBF(self.MBF_A, MBF_Labels)
-        MBF_data_B, Territories_B = self.ReadTerritoryMBF(self.MBF_B, MBF_Labels)
 
-        self.PlotBox(MBF_Labels, MBF_data_A, MBF_data_B)
+        #With -ReportFolder the figures are saved in the background. The report
+        #is opened first, so it gets ready while the cases are analyzed. A
+        #report set by the caller is left open
+        Report = self.Report
+        if Report is None and getattr(self.args, "ReportFolder", None) is not None:
+            self.Report = FigureReport(self.args.ReportFolder)
 
-        _, IndexMBF_A = super().Normalize(self.MBF_A)
-        _, IndexMBF_B = super().Normalize(self.MBF_B)
-        MBF_data_A, _ = self.ReadTerritoryMBF(IndexMBF_A, MBF_Labels, "IndexMBF")
-        MBF_data_B, _ = self.ReadTerritoryMBF(IndexMBF_B, MBF_Labels, "IndexMBF")
+        #The pre- and post-CABG cases are independent until they are compared
+        if getattr(self.args, "Parallel", False):
+            with Pool(2) as pool:
+                Results_A, Results_B = pool.starmap(self.AnalyzeCase, [("A", MBF_Labels), ("B", MBF_Labels)])
+        else:
+            Results_A = self.AnalyzeCase("A", MBF_Labels)
+            Results_B = self.AnalyzeCase("B", MBF_Labels)
 
-        self.PlotBox(MBF_Labels, MBF_data_A, MBF_data_B, "IndexMBF")
+        self.PlotBox(MBF_Labels, Results_A["MBF_data"], Results_B["MBF_data"])
+        self.PlotBox(MBF_Labels, Results_A["IndexMBF_data"], Results_B["IndexMBF_data"], "IndexMBF", "IndexMBF")
 
-        self.BarPlot(self.ProcessVolumeData(Territories_A, Territories_B))
+        if getattr(self.args, "SurfaceVolume", False):
+            self.PrintVolumeCheck(Results_A, Results_B)
+        self.BarPlot(self.ProcessVolumeData(Results_A, Results_B))
 
-    def ComputeVolume(self, ClosedSurface):
-        tri_filter = vtk.vtkTriangleFilter()
-        tri_filter.SetInputData(ClosedSurface)
-        tri_filter.Update()
-
-        cleaner = vtk.vtkCleanPolyData()
-        cleaner.SetInputData(tri_filter.GetOutput())
-        cleaner.Update()
+        if Report is None and self.Report is not None:
+            self.Report.Close()
+            self.Report = None
 
-        Mass = vtk.vtkMassProperties()
-        Mass.SetInputData(cleaner.GetOutput())
-        Mass.Update()
+    def ComputeVolume(self, ClosedSurface):
+        return SurfaceProperties(ClosedSurface)["Volume"]
+
+    def ComputeTerritoryVolume(self, MBFMap, MBF_Labels):
+        #Volume of the myocardium and of every territory as the sum of the
+        #volumes of their cells, gathered per label in one pass over the grid
+        Volumes = CellVolumes(MBFMap)
+        Labels = TerritoryCellLabels(MBFMap, "TerritoryMaps")
+        NumberOfLabels = Labels.max()+1 if len(Labels) > 0 else 0
+        LabelVolume = AggregateByLabel(Labels, Volumes, NumberOfLabels)
+        LabelCells = AggregateByLabel(Labels, None, NumberOfLabels)
+        Volume_data = {}
+        for (key, item) in MBF_Labels.items():
+            if SumOverLabels(LabelCells, item) > 0:
+                Volume_data[key] = SumOverLabels(LabelVolume, item)
 
-        return Mass.GetVolume()
+        return np.sum(Volumes), Volume_data
 
-    def ComputeTerritoryVolume(self, Territory):
+    def ComputeSurfaceTerritoryVolume(self, MBFMap, Territory):
+        #Volume enclosed by the surface of every territory, only used to
+        #cross-check ComputeTerritoryVolume
         Volume_data = {}
         for (key, item) in Territory.items():
-            if item.GetNumberOfPoints() > 0:
-                Volume_data[key] = self.ComputeVolume(ExtractSurface(item))
+            if len(item) > 0:
+                Volume_data[key] = self.ComputeVolume(ExtractSurface(ExtractCellsByIds(MBFMap, item)))
 
         return Volume_data
 
-    def ProcessVolumeData(self, Territories_A, Territories_B):
-        Volume_MBF_A = self.ComputeVolume(ExtractSurface(self.MBF_A))
-        Volume_MBF_B = self.ComputeVolume(ExtractSurface(self.MBF_B))
-        Volume_data_A = self.ComputeTerritoryVolume(Territories_A)
-        Volume_data_B = self.ComputeTerritoryVolume(Territories_B)
+    def PrintVolumeCheck(self, Results_A, Results_B):
+        print("--- Territory volumes from the cells and from the surfaces")
+        for (Case, Results) in (("PreCABG", Results_A), ("PostCABG", Results_B)):
+            Volumes = [("Myocardium", Results["Volume_MBF"], Results["SurfaceVolume_MBF"])]
+            Volumes += [(key, Results["Volume_data"][key], Results["SurfaceVolume_data"].get(key, np.nan)) for key in Results["Volume_data"].keys()]
+            for (key, CellVolume, SurfaceVolume) in Volumes:
+                print(f"{Case}, {key}, {CellVolume:.2f}, {SurfaceVolume:.2f}")
+
+    def ProcessVolumeData(self, Results_A, Results_B):
+        Volume_MBF_A, Volume_MBF_B = Results_A["Volume_MBF"], Results_B["Volume_MBF"]
+        Volume_data_A, Volume_data_B = Results_A["Volume_data"], Results_B["Volume_data"]
 
         data = {"Territory": [], "Time": [], "Value": []}
         data["Territory"].extend(["Myocardium", "Myocardium"])
@@ -135,14 +198,16 @@ class PrePostMBFMap(MBFNormalization):
         return data
 
     def BarPlot(self, data):
+        PlotFigure(self.Report, "BarPlot", ReportFileName(self.args.InputFolder, "Volume"), (8, 5), self.DrawBarPlot, data)
+
+    def DrawBarPlot(self, fig, data):
         df = pd.DataFrame(data)
-        plt.figure(figsize=(8, 5))
-        sns.barplot(data=df, x="Territory", y="Value", hue="Time", palette="pastel")
+        ax = fig.add_subplot()
+        sns.barplot(data=df, x="Territory", y="Value", hue="Time", palette="pastel", ax=ax)
 
-        plt.ylabel("Volume (mL)")
-        plt.xticks(rotation=45, ha="right")
-        plt.tight_layout()
-        plt.show()
+        ax.set_ylabel("Volume (mL)")
+        setp(ax.get_xticklabels(), rotation=45, ha="right")
+        fig.tight_layout()
 
 
 if __name__ == "__main__":
@@ -150,6 +215,10 @@ if __name__ == "__main__":
     parser.add_argument("-InputFolderPre", "--InputFolderPre", type=str, required= True, dest= "InputFolder")
     parser.add_argument("-InputMBF", "--InputMBF", dest= "InputMBF", type= str, required= False, default= "MBF_Territories.vtu")
     parser.add_argument("-InputLabels", "--InputLabels", dest= "InputLabels", type= str, required= False, default= "MBF_Territories_Labels.dat")
+    parser.add_argument("-ExcludeLayers", "--ExcludeLayers", type= int, dest= "ExcludeLayers", default= 0, required= False, help= "Number of boundary layers (LayerIndex) to leave out of the analysis")
+    parser.add_argument("-Parallel", "--Parallel", action= "store_true", default= False, required= False, dest= "Parallel", help= "Analyze the pre- and post-CABG cases in two worker processes")
+    parser.add_argument("-SurfaceVolume", "--SurfaceVolume", action= "store_true", default= False, required= False, dest= "SurfaceVolume", help= "Also compute the volumes from the territory surfaces and print both")
+    parser.add_argument("-ReportFolder", "--ReportFolder", type= str, default= None, required= False, dest= "ReportFolder", help= "Save the figures to this folder instead of showing them")
     args = parser.parse_args()
 
     PrePostMBFMap(args).main()
\ No newline at end of file
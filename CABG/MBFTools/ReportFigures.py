@@ -0,0 +1,83 @@
+import os
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+#The plots of the analysis scripts are written as Draw(fig, *args) functions
+#that only use the figure and its axes (no pyplot state). PlotFigure shows
+#them in a window, or hands them to a FigureReport to be saved to files
+
+class FigureReport():
+    #Renders figures to image files with the Agg backend on one background
+    #thread, so the next case can be computed meanwhile. Every figure has its
+    #own Agg canvas, the pyplot backend is left alone. A figure is kept per
+    #name and cleared to be reused by the next case. Only the worker thread
+    #touches the figures
+    def __init__(self, OutputFolder, Format="png", dpi=150):
+        os.makedirs(OutputFolder, exist_ok=True)
+        self.OutputFolder = OutputFolder
+        self.Format = Format
+        self.dpi = dpi
+        self.Figures = {}
+        self.Pending = []
+        self.Worker = ThreadPoolExecutor(max_workers=1)
+        #Fonts and the renderer are loaded by a first draw, done while the
+        #cases are analyzed when the report is opened before them
+        self.Pending.append(self.Worker.submit(self.WarmUp))
+
+    def WarmUp(self):
+        fig = Figure(figsize=(1, 1))
+        FigureCanvasAgg(fig)
+        fig.add_subplot().set_title("0")
+        fig.savefig(BytesIO(), format=self.Format)
+
+    def Render(self, Name, FileName, figsize, Draw, *args):
+        self.Pending.append(self.Worker.submit(self.RenderFigure, Name, FileName, figsize, Draw, args))
+
+    def RenderFigure(self, Name, FileName, figsize, Draw, args):
+        fig = self.Figures.get(Name)
+        if fig is None:
+            fig = Figure(figsize=figsize)
+            FigureCanvasAgg(fig)
+            self.Figures[Name] = fig
+        else:
+            fig.clf()
+            fig.set_size_inches(figsize)
+        Draw(fig, *args)
+        opath = os.path.join(self.OutputFolder, f"{FileName}.{self.Format}")
+        fig.savefig(opath, dpi=self.dpi)
+        return opath
+
+    def Wait(self):
+        #Waits for the figures submitted so far; errors of the drawing are raised here
+        Pending, self.Pending = self.Pending, []
+        return [opath for opath in (Future.result() for Future in Pending) if opath is not None]
+
+    def Close(self):
+        try:
+            self.Wait()
+        finally:
+            self.Worker.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+def PlotFigure(Report, Name, FileName, figsize, Draw, *args):
+    #Report=None keeps the interactive behaviour: the figure is shown and blocks
+    if Report is not None:
+        Report.Render(Name, FileName, figsize, Draw, *args)
+        return
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=figsize)
+    Draw(fig, *args)
+    plt.show()
+
+
+def ReportFileName(InputFolder, Name):
+    #e.g. ./CABG1A/ and IndexMBF -> CABG1A_IndexMBF
+    return f"{os.path.basename(os.path.normpath(InputFolder))}_{Name}"
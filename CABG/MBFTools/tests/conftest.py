@@ -0,0 +1,49 @@
+import os
+import sys
+import vtk
+import numpy as np
+import pytest
+from vtk.util.numpy_support import numpy_to_vtk
+
+MBFTools = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, MBFTools)
+sys.path.insert(1, os.path.dirname(MBFTools))
+
+def MakeTerritoryMap(FileName, Scale, Seed):
+    #A spherical shell of voxels with MBF ("scalars") and two territories
+    #split by the x axis (0: LAD, 1: LCx)
+    n = 24
+    Image = vtk.vtkImageData()
+    Image.SetDimensions(n, n, n)
+    Image.SetSpacing(0.5, 0.5, 0.5)
+    Image.SetOrigin(-6, -6, -6)
+    z, y, x = np.meshgrid(*(np.arange(n)*0.5 - 6,)*3, indexing="ij")
+    r = np.sqrt(x**2 + y**2 + z**2)
+    MBF = np.where((r > 3) & (r < 5.5), Scale*(100 + 10*np.random.default_rng(Seed).standard_normal(r.shape)), 0)
+    for (Name, Values) in (("scalars", MBF), ("TerritoryMaps", (x > 0).astype(np.float64))):
+        Array = numpy_to_vtk(Values.ravel().astype(np.float64), deep=True)
+        Array.SetName(Name)
+        Image.GetPointData().AddArray(Array)
+
+    Threshold = vtk.vtkThreshold()
+    Threshold.SetInputData(Image)
+    Threshold.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_POINTS, "scalars")
+    Threshold.SetLowerThreshold(1)
+    Threshold.SetUpperThreshold(1e9)
+    Threshold.Update()
+    Writer = vtk.vtkXMLUnstructuredGridWriter()
+    Writer.SetFileName(FileName)
+    Writer.SetInputData(Threshold.GetOutput())
+    Writer.Write()
+
+@pytest.fixture
+def PrePostCases(tmp_path):
+    #Pre-CABG (CABG1A) and post-CABG (CABG1B) folders as the analysis scripts expect them
+    for (Case, Scale, Seed) in (("A", 1.0, 0), ("B", 1.2, 1)):
+        Folder = tmp_path/f"CABG1{Case}"
+        Folder.mkdir()
+        MakeTerritoryMap(str(Folder/"MBF_Territories.vtu"), Scale, Seed)
+        with open(Folder/"MBF_Territories_Labels.dat", "w") as ofile:
+            ofile.write("TerritoryLabel CenterlineName\n0 L_LAD_1.vtp\n1 L_LCx_1.vtp\n")
+
+    return tmp_path
@@ -0,0 +1,54 @@
+import os
+import pytest
+from argparse import Namespace
+from multiprocessing import Pool
+from ExtractFlowPrePost import ExtractFlowPrePost
+from PrePostComparison import PrePostMBFMap
+from ReportFigures import FigureReport
+import CohortPrePostAnalysis
+
+def test_ExtractFlowPrePost_Parallel_ReportFolder(PrePostCases):
+    ReportFolder = str(PrePostCases/"Report")
+    args = Namespace(InputFolder=str(PrePostCases/"CABG1A"), InputMBF="MBF_Territories.vtu", InputLabels="MBF_Territories_Labels.dat",
+                     ArrayName=0, TerritoryTag=["LAD"], Unit="cm", ExcludeLayers=0, Parallel=True, ReportFolder=ReportFolder)
+    ExtractFlowPrePost(args).main()
+
+    assert sorted(os.listdir(ReportFolder)) == ["CABG1A_IndexMBF.png", "CABG1A_RelativeFlow.png"]
+    assert os.path.isfile(PrePostCases/"CABG1A"/"PrePostStatistics.dat")
+
+def test_PrePostComparison_Parallel_Report(PrePostCases):
+    #The cases go to the pool with a copy of the analysis, without the report
+    args = Namespace(InputFolder=str(PrePostCases/"CABG1A"), InputMBF="MBF_Territories.vtu", InputLabels="MBF_Territories_Labels.dat",
+                     ExcludeLayers=0, Parallel=True, ReportFolder=None)
+    Analysis = PrePostMBFMap(args)
+    with FigureReport(str(PrePostCases/"Report")) as Report:
+        Analysis.Report = Report
+        MBF_Labels = Analysis.ReadMBFLabels()
+        with Pool(2) as pool:
+            Results_A, Results_B = pool.starmap(Analysis.AnalyzeCase, [("A", MBF_Labels), ("B", MBF_Labels)])
+        assert Analysis.Report is Report
+
+    assert Results_A["Volume_data"].keys() == Results_B["Volume_data"].keys() == {"LAD", "LCx"}
+    assert Results_B["Volume_MBF"] > 0
+
+def test_CohortPrePostAnalysis_DrawingErrorOfOwnPatient(PrePostCases, monkeypatch):
+    #A drawing error fails the patient that drew the figure, the next patient
+    #of the same worker is not affected
+    monkeypatch.setattr(CohortPrePostAnalysis, "WorkerReport", None)
+    ReportFolder = str(PrePostCases/"Report")
+    Options = {"InputMBF": "MBF_Territories.vtu", "InputLabels": "MBF_Territories_Labels.dat", "ArrayName": 0, "TerritoryTag": ["LAD"],
+               "Unit": "cm", "ExcludeLayers": 0, "Parallel": False, "ReportFolder": ReportFolder}
+    DrawBarPlot = ExtractFlowPrePost.DrawBarPlot
+    def FailingDrawBarPlot(self, fig, BarData, ylabel):
+        raise ValueError("drawing failed")
+
+    monkeypatch.setattr(ExtractFlowPrePost, "DrawBarPlot", FailingDrawBarPlot)
+    with pytest.raises(ValueError, match="drawing failed"):
+        CohortPrePostAnalysis.AnalyzePatient(str(PrePostCases/"CABG1A"), Options)
+
+    monkeypatch.setattr(ExtractFlowPrePost, "DrawBarPlot", DrawBarPlot)
+    Rows = CohortPrePostAnalysis.AnalyzePatient(str(PrePostCases/"CABG1A"), Options)
+    CohortPrePostAnalysis.WorkerReport.Close()
+
+    assert len(Rows) > 0
+    assert os.listdir(ReportFolder) == ["CABG1A_IndexMBF.png"]
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+from utilities import DescribeArray, QuantileSketch, Quantiles, Statistics
+
+def RankError(Values, Estimates, Probabilities):
+    #Distance between the rank of every estimate and the rank it should have
+    SortedValues = np.sort(Values)
+    Ranks = np.searchsorted(SortedValues, Estimates)/len(Values)
+    return np.abs(Ranks - np.asarray(Probabilities))
+
+def test_Quantiles_match_percentile():
+    Values = np.random.default_rng(0).gamma(2., 50., 100001)
+    Probabilities = [0.01, 0.25, 0.5, 0.75, 0.99]
+    assert np.allclose(Quantiles(Values, Probabilities), np.percentile(Values, np.multiply(Probabilities, 100)))
+
+@pytest.mark.parametrize("Seed", [0, 1, 2])
+def test_QuantileSketch_accuracy(Seed):
+    Values = np.random.default_rng(Seed).gamma(2., 50., 1000000)
+    Probabilities = [0.05, 0.25, 0.5, 0.75, 0.95]
+    Sketch = QuantileSketch(K=2000)
+    for Chunk in np.array_split(Values, 37):
+        Sketch.Update(Chunk)
+
+    Estimates = Sketch.Quantiles(Probabilities)
+    assert sum(len(Level) for Level in Sketch.Levels) < 10*Sketch.K
+    assert np.all(RankError(Values, Estimates, Probabilities) < 0.005)
+    Exact = np.percentile(Values, np.multiply(Probabilities, 100))
+    assert np.allclose(Estimates, Exact, rtol=0.02)
+
+def test_DescribeArray_Approximate():
+    Values = np.random.default_rng(3).normal(100., 15., 500000).astype(np.float32)
+    Exact = DescribeArray(Values)
+    Approximate = DescribeArray(Values, Approximate=True, ChunkSize=65536)
+    Chunked = DescribeArray(iter(np.array_split(Values, 10)), Approximate=True)
+
+    assert np.isclose(Exact["Median"], np.percentile(Values, 50))
+    for Result in (Approximate, Chunked):
+        assert np.isclose(Result["Mean"], Exact["Mean"]) and np.isclose(Result["std"], Exact["std"])
+        for Name in ("25thPerct", "Median", "75thPerct"):
+            assert abs(Result[Name] - Exact[Name]) < 0.02*Exact["std"]
+
+def test_Statistics_Approximate():
+    Image = vtk.vtkImageData()
+    Image.SetDimensions(60, 60, 60)
+    Values = np.random.default_rng(4).normal(100., 15., 60**3)
+    Array = numpy_to_vtk(Values, deep=True)
+    Array.SetName("scalars")
+    Image.GetPointData().AddArray(Array)
+    Exact = Statistics(Image, "scalars")
+    Approximate = Statistics(Image, "scalars", Approximate=True)
+
+    assert np.isclose(Exact["75thPerct"], np.percentile(Values, 75))
+    assert np.isnan(Approximate["Mode"])
+    for Name in ("Mean", "Stdev", "Skewness", "Kurtosis", "Volume"):
+        assert np.isclose(Approximate[Name], Exact[Name])
+    for Name in ("Median", "75thPerct", "IQR"):
+        assert abs(Approximate[Name] - Exact[Name]) < 0.02*Exact["Stdev"]
@@ -0,0 +1,36 @@
+import vtk
+import numpy as np
+import utilities
+from utilities import SurfaceCache
+
+def Sphere(Radius):
+    Source = vtk.vtkSphereSource()
+    Source.SetRadius(Radius)
+    Source.SetThetaResolution(40)
+    Source.SetPhiResolution(40)
+    Source.Update()
+    return Source.GetOutput()
+
+def test_SurfaceCache_triangulates_once(monkeypatch):
+    Calls = []
+    Triangulate = utilities.TriangulateAndClean
+    monkeypatch.setattr(utilities, "TriangulateAndClean", lambda Surface: Calls.append(1) or Triangulate(Surface))
+    Cache = SurfaceCache()
+    Surface = Sphere(1.)
+    Volume = Cache.Properties(Surface)["Volume"]
+    Triangulated = Cache.Triangulated(Surface)
+
+    #A copy of the same geometry in another object is the same entry
+    Copy = vtk.vtkPolyData()
+    Copy.DeepCopy(Surface)
+    assert Cache.Triangulated(Copy) is Triangulated
+    assert Cache.Properties(Copy)["Volume"] == Volume
+    assert len(Calls) == 1
+    assert np.isclose(Volume, 4/3*np.pi, rtol=0.01)
+
+def test_SurfaceCache_content_key():
+    #New surfaces (possibly reusing the id of a freed one) get their own entries
+    Cache = SurfaceCache(SurfaceSize=2)
+    Volumes = [Cache.Properties(Sphere(Radius))["Volume"] for Radius in (1., 2., 3.)]
+    assert np.allclose(np.divide(Volumes, Volumes[0]), [1, 8, 27], rtol=0.01)
+    assert len(Cache.Surfaces) == 2 and len(Cache.Entries) == 3
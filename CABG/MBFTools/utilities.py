@@ -2,12 +2,12 @@ import vtk
 #from vmtk import vtkvmtk, vmtkscripts
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 import numpy as np
+import hashlib
+import os
 from glob import glob
+from collections import OrderedDict
 from scipy.spatial import distance as DISTANCE
-from scipy.stats import iqr as IQR
-from scipy.stats import kurtosis as KURTOSIS
-from scipy.stats import skew as SKEWNESS
-from scipy.stats import mode as MODE
+from scipy.spatial import cKDTree
 
 
 ############ Read Dicom Folder ############
@@ -71,6 +71,572 @@ def WriteVTPFile(FileName,Data):
 	writer.SetInputData(Data)
 	writer.Update()
 
+def FileFingerprint(FileName):
+	#Hash of the file content, used to detect edited input files
+	Hash=hashlib.md5()
+	with open(FileName,"rb") as infile:
+		for Chunk in iter(lambda: infile.read(1<<20),b""):
+			Hash.update(Chunk)
+	return Hash.hexdigest()
+
+def FileStamp(FileName):
+	#Size and modification time of the file, a check for edited input files
+	#that does not read them
+	FileStat=os.stat(FileName)
+	return (FileStat.st_size,FileStat.st_mtime_ns)
+
+############ NumPy Data Access ##################
+#These return views on the VTK buffers (no copy), so the dataset has to
+#stay alive while the array is used and edits go straight into the mesh
+
+def GetPointCoordinates(DataSet):
+	#Image data has implicit points, so build them from origin and spacing
+	if isinstance(DataSet,vtk.vtkImageData):
+		Dims=DataSet.GetDimensions()
+		Origin=np.array(DataSet.GetOrigin())
+		Spacing=np.array(DataSet.GetSpacing())
+		Z,Y,X=np.meshgrid(np.arange(Dims[2]),np.arange(Dims[1]),np.arange(Dims[0]),indexing="ij")
+		return np.column_stack((X.ravel(),Y.ravel(),Z.ravel()))*Spacing+Origin
+	if DataSet.GetPoints() is None:
+		return np.zeros(shape=(0,3))
+	return vtk_to_numpy(DataSet.GetPoints().GetData())
+
+def GetPointArray(DataSet,ArrayName):
+	return vtk_to_numpy(DataSet.GetPointData().GetArray(ArrayName))
+
+def GetCellArray(DataSet,ArrayName):
+	return vtk_to_numpy(DataSet.GetCellData().GetArray(ArrayName))
+
+def GetCellConnectivity(DataSet):
+	#Returns the offsets and the flat point-id connectivity of the cells,
+	#cell i uses Connectivity[Offsets[i]:Offsets[i+1]]
+	if isinstance(DataSet,vtk.vtkPolyData):
+		Cells=DataSet.GetPolys() if DataSet.GetNumberOfPolys()>0 else DataSet.GetLines()
+	else:
+		Cells=DataSet.GetCells()
+	Offsets=vtk_to_numpy(Cells.GetOffsetsArray())
+	Connectivity=vtk_to_numpy(Cells.GetConnectivityArray())
+	return Offsets,Connectivity
+
+def GetCellEdges(DataSet):
+	#Unique point pairs (i<j) that share a cell. Every pair of points within
+	#a cell is connected, so voxels also get their face and body diagonals
+	Offsets,Connectivity=GetCellConnectivity(DataSet)
+	CellSizes=np.diff(Offsets)
+	Keys=[]
+	N=DataSet.GetNumberOfPoints()
+	for CellSize in np.unique(CellSizes):
+		#Cells with the same number of points are handled together
+		CellStarts=Offsets[:-1][CellSizes==CellSize]
+		CellPoints=Connectivity[CellStarts[:,None]+np.arange(CellSize)].astype(np.int64)
+		First,Second=np.triu_indices(CellSize,k=1)
+		I=CellPoints[:,First].ravel()
+		J=CellPoints[:,Second].ravel()
+		Keys.append((np.minimum(I,J)*N+np.maximum(I,J))[I!=J])
+	if len(Keys)==0:
+		return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+	Keys=np.unique(np.concatenate(Keys))
+	return Keys//N,Keys%N
+
+def SelectCells(Offsets,Connectivity,CellIds):
+	#Offsets and connectivity of a subset of the cells, in the order of CellIds
+	CellSizes=np.diff(Offsets)[CellIds]
+	SubsetOffsets=np.concatenate(([0],np.cumsum(CellSizes))).astype(np.int64)
+	Positions=np.arange(SubsetOffsets[-1])+np.repeat(Offsets[:-1][CellIds]-SubsetOffsets[:-1],CellSizes)
+	return SubsetOffsets,Connectivity[Positions]
+
+############ Flow Integration ##################
+#CellIds restricts the computation to those cells (e.g. one territory),
+#None means all cells of the dataset
+
+def CellBoundingBoxVolumes(DataSet,CellIds=None):
+	#Volume of the axis-aligned bounding box of every cell (exact for voxels)
+	Offsets,Connectivity=GetCellConnectivity(DataSet)
+	if CellIds is not None:
+		Offsets,Connectivity=SelectCells(Offsets,Connectivity,CellIds)
+	if len(Offsets)<2:
+		return np.zeros(0)
+	CellPoints=GetPointCoordinates(DataSet)[Connectivity].astype(np.float64)
+	Extent=np.maximum.reduceat(CellPoints,Offsets[:-1],axis=0)-np.minimum.reduceat(CellPoints,Offsets[:-1],axis=0)
+	return Extent[:,0]*Extent[:,1]*Extent[:,2]
+
+def CellVolumes(DataSet,CellIds=None):
+	#Volume of every cell. Grids made only of voxels (image-derived maps)
+	#use the bounding boxes, any other grid vtkCellSizeFilter
+	if DataSet.GetNumberOfCells()==0 or (DataSet.IsA("vtkUnstructuredGrid") and DataSet.IsHomogeneous() and DataSet.GetCellType(0)==vtk.VTK_VOXEL):
+		return CellBoundingBoxVolumes(DataSet,CellIds)
+	CellSize=vtk.vtkCellSizeFilter()
+	CellSize.SetInputData(DataSet)
+	CellSize.ComputeVertexCountOff()
+	CellSize.ComputeLengthOff()
+	CellSize.ComputeAreaOff()
+	CellSize.ComputeSumOff()
+	CellSize.Update()
+	Volumes=vtk_to_numpy(CellSize.GetOutput().GetCellData().GetArray("Volume"))
+	return Volumes if CellIds is None else Volumes[CellIds]
+
+def CellAverageOfPointArray(DataSet,ArrayName,CellIds=None):
+	#Mean of a point array over the points of every cell
+	Offsets,Connectivity=GetCellConnectivity(DataSet)
+	if CellIds is not None:
+		Offsets,Connectivity=SelectCells(Offsets,Connectivity,CellIds)
+	if len(Offsets)<2:
+		return np.zeros(0)
+	PointValues=GetPointArray(DataSet,ArrayName)[Connectivity].astype(np.float64)
+	return np.add.reduceat(PointValues,Offsets[:-1])/np.diff(Offsets)
+
+def CellDataFlow(DataSet,ArrayName,Unit,CellIds=None):
+	#Flow (MBF x cell volume) of every cell, the total volume and the number
+	#of cells. MBF is in mL/min/100mL, so flow is in mL/min and volume in mL
+	CellVolumes=CellBoundingBoxVolumes(DataSet,CellIds)
+	MBF=GetCellArray(DataSet,ArrayName)
+	Flow=(MBF if CellIds is None else MBF[CellIds])*CellVolumes
+	TerritoryVolume=np.sum(CellVolumes)
+	if Unit=='mm':
+		return Flow/1000/100,TerritoryVolume/1000,len(CellVolumes)
+	elif Unit=='cm':
+		return Flow/100,TerritoryVolume,len(CellVolumes)
+
+############ Territory Aggregation ##################
+def TerritoryCellLabels(DataSet,arrayname="TerritoryMaps"):
+	#Territory label of every cell, -1 if the cell is not within one territory.
+	#This keeps the same cells as vtkThreshold(label,label): with point data
+	#all points of the cell must carry the label, with cell data (e.g. after
+	#vtkPointDataToCellData) the cell value must be exactly the label
+	if DataSet.GetCellData().GetArray(arrayname) is not None:
+		Lower=Upper=GetCellArray(DataSet,arrayname)
+	else:
+		Offsets,Connectivity=GetCellConnectivity(DataSet)
+		if len(Offsets)<2:
+			return np.zeros(0,dtype=np.int64)
+		PointLabels=GetPointArray(DataSet,arrayname)[Connectivity]
+		Lower=np.minimum.reduceat(PointLabels,Offsets[:-1])
+		Upper=np.maximum.reduceat(PointLabels,Offsets[:-1])
+	Labels=np.rint(Lower).astype(np.int64)
+	Labels[(Lower!=Upper)|(Labels!=Lower)]=-1
+	return Labels
+
+def AggregateByLabel(Labels,Values=None,NumberOfLabels=0):
+	#Sum of Values (or count if None) for every label in a single pass.
+	#Entries with a negative label are left out
+	Valid=Labels>=0
+	Weights=None if Values is None else np.asarray(Values)[Valid]
+	return np.bincount(Labels[Valid],weights=Weights,minlength=NumberOfLabels)
+
+def SumOverLabels(PerLabel,LabelList):
+	#Sum of a per-label array over a group of labels
+	LabelList=[Label for Label in LabelList if 0<=Label<len(PerLabel)]
+	return np.sum(PerLabel[LabelList])
+
+def AggregateTerritories(DataSet,ArrayName,Unit,arrayname="TerritoryMaps",Labels=None):
+	#Number of cells, volume (mL), flow (mL/min) and MBF sum of every
+	#territory label from one pass over the cells, indexed by label
+	if Labels is None:
+		Labels=TerritoryCellLabels(DataSet,arrayname)
+	NumberOfLabels=Labels.max()+1 if len(Labels)>0 else 0
+	CellVolumes=CellBoundingBoxVolumes(DataSet)
+	MBF=GetCellArray(DataSet,ArrayName)
+	Scale=1000 if Unit=='mm' else 1
+	return {"NCells":AggregateByLabel(Labels,None,NumberOfLabels),
+		"Volume":AggregateByLabel(Labels,CellVolumes,NumberOfLabels)/Scale,
+		"Flow":AggregateByLabel(Labels,MBF*CellVolumes,NumberOfLabels)/Scale/100,
+		"MBF":AggregateByLabel(Labels,MBF,NumberOfLabels)}
+
+def LabelIndex(Labels):
+	#Compressed (CSR) index of the ids of every label: the ids with label L
+	#are Ids[Offsets[L]:Offsets[L+1]]. Entries with a negative label are left out
+	Ids=np.argsort(Labels,kind="stable")
+	Ids=Ids[np.count_nonzero(Labels<0):]
+	Counts=np.bincount(Labels[Ids]) if len(Ids)>0 else np.zeros(0,dtype=np.int64)
+	Offsets=np.concatenate(([0],np.cumsum(Counts))).astype(np.int64)
+	return Offsets,Ids
+
+def LabelIds(Offsets,Ids,LabelList):
+	#Ids that belong to any of the labels in LabelList
+	Slices=[Ids[Offsets[Label]:Offsets[Label+1]] for Label in LabelList if 0<=Label<len(Offsets)-1]
+	if len(Slices)==0:
+		return np.zeros(0,dtype=np.int64)
+	return np.concatenate(Slices)
+
+def LabelGroupSummaries(Labels,Values,LabelGroups,Weights=None):
+	#Count, mean, weighted mean (e.g. by area), median and quartiles of Values
+	#over every group of labels (e.g. territory -> labels). The entries of all
+	#groups are gathered from one label index and sorted together once
+	Offsets,Ids=LabelIndex(Labels)
+	Keys=list(LabelGroups.keys())
+	Members=[LabelIds(Offsets,Ids,LabelGroups[key]) for key in Keys]
+	Counts=np.array([len(Member) for Member in Members],dtype=np.int64)
+	Group=np.repeat(np.arange(len(Keys)),Counts)
+	Members=np.concatenate(Members) if len(Keys)>0 else np.zeros(0,dtype=np.int64)
+	GroupValues=np.asarray(Values,dtype=np.float64)[Members]
+	GroupWeights=np.ones(len(Members)) if Weights is None else np.asarray(Weights,dtype=np.float64)[Members]
+	Sums=np.bincount(Group,weights=GroupValues,minlength=len(Keys))
+	WeightedSums=np.bincount(Group,weights=GroupValues*GroupWeights,minlength=len(Keys))
+	TotalWeights=np.bincount(Group,weights=GroupWeights,minlength=len(Keys))
+	SortedValues=GroupValues[np.lexsort((GroupValues,Group))]
+	Starts=np.concatenate(([0],np.cumsum(Counts)))
+	Summaries={}
+	for (i,key) in enumerate(Keys):
+		Summary={"N":int(Counts[i]),"Mean":np.nan,"Median":np.nan,"25thPerct":np.nan,"75thPerct":np.nan,"WeightedMean":np.nan,"Weight":TotalWeights[i]}
+		if Counts[i]>0:
+			Q25,Median,Q75=Quantiles(SortedValues[Starts[i]:Starts[i+1]],[0.25,0.5,0.75],Sorted=True)
+			Summary.update({"Mean":Sums[i]/Counts[i],"Median":Median,"25thPerct":Q25,"75thPerct":Q75})
+			if TotalWeights[i]>0:
+				Summary["WeightedMean"]=WeightedSums[i]/TotalWeights[i]
+		Summaries[key]=Summary
+	return Summaries
+
+def CellPointIds(DataSet,CellIds):
+	#Unique ids of the points used by the given cells
+	Offsets,Connectivity=GetCellConnectivity(DataSet)
+	Mask=np.zeros(len(Offsets)-1,dtype=bool)
+	Mask[CellIds]=True
+	return np.unique(Connectivity[np.repeat(Mask,np.diff(Offsets))])
+
+def ExtractCellsByIds(DataSet,CellIds):
+	#Sub-grid made of the given cells. Only needed when the territory geometry
+	#is used, the arrays can be sliced directly with the cell ids
+	SelectionList=numpy_to_vtk(np.asarray(CellIds,dtype=np.int64),deep=True,array_type=vtk.VTK_ID_TYPE)
+	SelectionNode=vtk.vtkSelectionNode()
+	SelectionNode.SetFieldType(vtk.vtkSelectionNode.CELL)
+	SelectionNode.SetContentType(vtk.vtkSelectionNode.INDICES)
+	SelectionNode.SetSelectionList(SelectionList)
+	Selection=vtk.vtkSelection()
+	Selection.AddNode(SelectionNode)
+	Extract=vtk.vtkExtractSelection()
+	Extract.SetInputData(0,DataSet)
+	Extract.SetInputData(1,Selection)
+	Extract.Update()
+	return Extract.GetOutput()
+
+############ Territory Index ##################
+#Label -> cell ids and label -> point ids of the territories, stored beside
+#the MBF_Territories file and rebuilt whenever that file changes. Only valid
+#for the mesh as it is on disk, not after cells have been removed from it
+
+def TerritoryIndexFileName(FileName):
+	return os.path.splitext(FileName)[0]+"_TerritoryIndex.npz"
+
+def BuildTerritoryIndex(DataSet,arrayname="TerritoryMaps"):
+	#Cells are indexed by TerritoryCellLabels, points by the territory of the
+	#cells that use them, i.e. the points that vtkThreshold(label,label) keeps.
+	#The averaged cells are the ones that carry the label once the point
+	#labels are averaged into the cells by vtkPointDataToCellData
+	CellLabels=TerritoryCellLabels(DataSet,arrayname)
+	if DataSet.GetPointData().GetArray(arrayname) is not None:
+		PointToCell=vtk.vtkPointDataToCellData()
+		PointToCell.SetInputData(DataSet)
+		PointToCell.ProcessAllArraysOff()
+		PointToCell.AddPointDataArray(arrayname)
+		PointToCell.Update()
+		AveragedCellLabels=TerritoryCellLabels(PointToCell.GetOutput(),arrayname)
+	else:
+		AveragedCellLabels=CellLabels
+	Offsets,Connectivity=GetCellConnectivity(DataSet)
+	ConnectivityLabels=np.repeat(CellLabels,np.diff(Offsets))
+	PointLabels=np.full(DataSet.GetNumberOfPoints(),-1,dtype=np.int64)
+	PointLabels[Connectivity[ConnectivityLabels>=0]]=ConnectivityLabels[ConnectivityLabels>=0]
+	CellOffsets,CellIds=LabelIndex(CellLabels)
+	PointOffsets,PointIds=LabelIndex(PointLabels)
+	AveragedCellOffsets,AveragedCellIds=LabelIndex(AveragedCellLabels)
+	return {"CellOffsets":CellOffsets,"CellIds":CellIds,"PointOffsets":PointOffsets,"PointIds":PointIds,
+		"AveragedCellOffsets":AveragedCellOffsets,"AveragedCellIds":AveragedCellIds}
+
+def ReadTerritoryIndex(FileName,DataSet=None,arrayname="TerritoryMaps"):
+	#Load the index of FileName, or build and store it if it is missing or
+	#older than the file (compared by file size and modification time)
+	Stamp=np.array(FileStamp(FileName),dtype=np.int64)
+	IndexFileName=TerritoryIndexFileName(FileName)
+	if os.path.exists(IndexFileName):
+		with np.load(IndexFileName) as IndexFile:
+			if np.array_equal(IndexFile["Stamp"],Stamp):
+				return {Key:IndexFile[Key] for Key in IndexFile.files if Key!="Stamp"}
+	if DataSet is None:
+		DataSet=ReadVTUFile(FileName)
+	Index=BuildTerritoryIndex(DataSet,arrayname)
+	try:
+		np.savez(IndexFileName,Stamp=Stamp,**Index)
+	except OSError:
+		print ("--- Could not write the territory index: %s"%IndexFileName)
+	return Index
+
+def GetTerritoryIndex(FileName,DataSet,Layers=0,arrayname="TerritoryMaps"):
+	#DataSet is FileName after RemoveBoundaryLayers(Layers). With boundary
+	#layers removed the stored index does not apply, so build it in memory
+	if Layers>0:
+		return BuildTerritoryIndex(DataSet,arrayname)
+	return ReadTerritoryIndex(FileName,DataSet,arrayname)
+
+def TerritoryCellIds(Index,LabelList,Averaged=False):
+	if Averaged:
+		return LabelIds(Index["AveragedCellOffsets"],Index["AveragedCellIds"],LabelList)
+	return LabelIds(Index["CellOffsets"],Index["CellIds"],LabelList)
+
+def TerritoryPointIds(Index,LabelList):
+	return LabelIds(Index["PointOffsets"],Index["PointIds"],LabelList)
+
+############ Surface Distance ##################
+def ClosestPointOnTriangles(P,A,B,C):
+	#Closest point to P on every triangle ABC (rows), from the Voronoi region
+	#of P (Ericson, Real-Time Collision Detection 5.1.5), as A+v*AB+w*AC. The
+	#regions are applied from the last to the first so the first that holds wins
+	AB=B-A
+	AC=C-A
+	AP=P-A
+	d1=np.einsum("ij,ij->i",AB,AP)
+	d2=np.einsum("ij,ij->i",AC,AP)
+	ABAB=np.einsum("ij,ij->i",AB,AB)
+	ABAC=np.einsum("ij,ij->i",AB,AC)
+	ACAC=np.einsum("ij,ij->i",AC,AC)
+	#Same dot products as in the book, from BP=AP-AB and CP=AP-AC
+	d3=d1-ABAB
+	d4=d2-ABAC
+	d5=d1-ABAC
+	d6=d2-ACAC
+	va=d3*d6-d5*d4
+	vb=d5*d2-d1*d6
+	vc=d1*d4-d3*d2
+	with np.errstate(divide="ignore",invalid="ignore"):
+		Denom=va+vb+vc
+		v=vb/Denom
+		w=vc/Denom
+		Regions=[
+			((va<=0)&(d4>=d3)&(d5>=d6),lambda: 1-(d4-d3)/((d4-d3)+(d5-d6)),lambda: (d4-d3)/((d4-d3)+(d5-d6))),
+			((vb<=0)&(d2>=0)&(d6<=0),lambda: 0,lambda: d2/(d2-d6)),
+			((d6>=0)&(d5<=d6),lambda: 0,lambda: 1),
+			((vc<=0)&(d1>=0)&(d3<=0),lambda: d1/(d1-d3),lambda: 0),
+			((d3>=0)&(d4<=d3),lambda: 1,lambda: 0),
+			((d1<=0)&(d2<=0),lambda: 0,lambda: 0)]
+		for (Region,RegionV,RegionW) in Regions:
+			if np.any(Region):
+				v=np.where(Region,RegionV(),v)
+				w=np.where(Region,RegionW(),w)
+	return A+AB*v[:,None]+AC*w[:,None]
+
+class TriangleLocator():
+	#Exact closest triangle of a surface for many points at once. A bounding
+	#volume hierarchy over the triangles is built by median splits along the
+	#longest axis, level by level, and all the points of a chunk descend it
+	#together: a node is only kept for a point if its box is closer than the
+	#best triangle distance found so far among the nearest triangle centroids
+	def __init__(self,Surface,LeafSize=2,K=1):
+		if not np.all(np.diff(GetCellConnectivity(Surface)[0])==3):
+			Triangles=vtk.vtkTriangleFilter()
+			Triangles.SetInputData(Surface)
+			Triangles.Update()
+			Surface=Triangles.GetOutput()
+		Offsets,Connectivity=GetCellConnectivity(Surface)
+		self.Vertices=GetPointCoordinates(Surface).astype(np.float64)[Connectivity.reshape(-1,3)]
+		Centroids=self.Vertices.mean(axis=1)
+		self.Tree=cKDTree(Centroids)
+		self.K=min(K,len(Centroids))
+		self.BuildHierarchy(Centroids,LeafSize)
+
+	def BuildHierarchy(self,Centroids,LeafSize):
+		#Level l has 2**l nodes, node j covers Order[Starts[j]:Ends[j]] and has
+		#the children 2j and 2j+1
+		N=len(Centroids)
+		Order=np.arange(N)
+		Starts=np.zeros(1,dtype=np.int64)
+		Ends=np.full(1,N,dtype=np.int64)
+		self.Levels=[]
+		while True:
+			#Boxes are kept as centre and half size, empty nodes with NaN
+			BoxMin,BoxMax=self.NodeBoxes(Order,Starts,Ends)
+			with np.errstate(invalid="ignore"):
+				self.Levels.append(np.stack(((BoxMin+BoxMax)/2,(BoxMax-BoxMin)/2),axis=1))
+			if N==0 or np.max(Ends-Starts)<=LeafSize:
+				break
+			Sizes=Ends-Starts
+			Node=np.repeat(np.arange(len(Starts)),Sizes)
+			Box=self.NodeBoxes(Order,Starts,Ends,Centroids)
+			Axis=np.argmax(Box[1]-Box[0],axis=1)
+			Order=Order[np.lexsort((Centroids[Order,Axis[Node]],Node))]
+			Middles=Starts+Sizes//2
+			Starts=np.column_stack((Starts,Middles)).ravel()
+			Ends=np.column_stack((Middles,Ends)).ravel()
+		self.Order=Order
+		self.LeafStarts=Starts
+		self.LeafEnds=Ends
+
+	def NodeBoxes(self,Order,Starts,Ends,Centroids=None):
+		Points=self.Vertices[Order] if Centroids is None else Centroids[Order][:,None]
+		BoxMin=np.full((len(Starts),3),np.inf)
+		BoxMax=np.full((len(Starts),3),-np.inf)
+		Filled=Ends>Starts
+		if len(Order)>0 and np.any(Filled):
+			BoxMin[Filled]=np.minimum.reduceat(Points.min(axis=1),Starts[Filled],axis=0)
+			BoxMax[Filled]=np.maximum.reduceat(Points.max(axis=1),Starts[Filled],axis=0)
+		return BoxMin,BoxMax
+
+	def TriangleDistances(self,Points,TriangleIds):
+		Vertices=self.Vertices[TriangleIds]
+		Q=ClosestPointOnTriangles(Points,Vertices[:,0],Vertices[:,1],Vertices[:,2])
+		Distances=np.sqrt(np.einsum("ij,ij->i",Points-Q,Points-Q))
+		#Degenerate triangles give NaN, their closest vertex is used instead
+		Degenerate=np.isnan(Distances)
+		if np.any(Degenerate):
+			Distances[Degenerate]=np.min(np.linalg.norm(Vertices[Degenerate]-Points[Degenerate][:,None],axis=2),axis=1)
+		return Distances
+
+	def FindClosestChunk(self,Points):
+		#Upper bound from the triangles of the K nearest centroids
+		_,Nearest=self.Tree.query(Points,k=self.K)
+		Nearest=Nearest.reshape(len(Points),-1)
+		Bound=self.TriangleDistances(np.repeat(Points,Nearest.shape[1],axis=0),Nearest.ravel()).reshape(Nearest.shape).min(axis=1)
+		Bound2=(Bound*(1+1e-9)+1e-12)**2
+		#Descend the hierarchy with all (point, node) pairs of the chunk
+		PointIds=np.arange(len(Points))
+		NodeIds=np.zeros(len(Points),dtype=np.int64)
+		for (Level,Boxes) in enumerate(self.Levels):
+			Box=Boxes[NodeIds]
+			Gap=np.abs(Points[PointIds]-Box[:,0])-Box[:,1]
+			np.maximum(Gap,0,out=Gap)
+			#NaN (empty node) compares False and is dropped
+			Keep=np.einsum("ij,ij->i",Gap,Gap)<=Bound2[PointIds]
+			PointIds,NodeIds=PointIds[Keep],NodeIds[Keep]
+			if Level<len(self.Levels)-1:
+				PointIds=np.repeat(PointIds,2)
+				NodeIds=(NodeIds[:,None]*2+np.arange(2)).ravel()
+		#Exact distances to the triangles of the leaves that are left
+		Counts=self.LeafEnds[NodeIds]-self.LeafStarts[NodeIds]
+		Positions=np.arange(np.sum(Counts))+np.repeat(self.LeafStarts[NodeIds]-np.concatenate(([0],np.cumsum(Counts)[:-1])),Counts)
+		PointIds=np.repeat(PointIds,Counts)
+		TriangleIds=self.Order[Positions]
+		Distances=self.TriangleDistances(Points[PointIds],TriangleIds)
+		#The pairs stay sorted by point, so the minimum of every point is a
+		#reduction over its group (the first triangle in case of a tie)
+		Starts=np.flatnonzero(np.diff(PointIds,prepend=-1))
+		Minimum=np.minimum.reduceat(Distances,Starts)
+		Positions=np.where(Distances==np.repeat(Minimum,np.diff(np.append(Starts,len(Distances)))),np.arange(len(Distances)),len(Distances))
+		return Minimum,TriangleIds[np.minimum.reduceat(Positions,Starts)]
+
+	def FindClosestCells(self,Points,ChunkSize=4096,Threads=None):
+		#Distance to the surface and id of the closest triangle of every point.
+		#Chunks bound the memory of the (point, node) pairs and run on threads
+		from concurrent.futures import ThreadPoolExecutor
+		Points=np.asarray(Points,dtype=np.float64).reshape(-1,3)
+		Distances=np.zeros(len(Points))
+		CellIds=np.zeros(len(Points),dtype=np.int64)
+		if len(Points)==0 or self.K==0:
+			return Distances,CellIds-1
+		Chunks=[slice(i,i+ChunkSize) for i in range(0,len(Points),ChunkSize)]
+		with ThreadPoolExecutor(Threads or os.cpu_count()) as pool:
+			for Chunk,(Distance,CellId) in zip(Chunks,pool.map(lambda Chunk: self.FindClosestChunk(Points[Chunk]),Chunks)):
+				Distances[Chunk]=Distance
+				CellIds[Chunk]=CellId
+		return Distances,CellIds
+
+############ Array Transfer ##################
+def ClosestPointIds(Source,Points):
+	#Id of the closest point of Source (a dataset or an array of coordinates)
+	#to every one of Points, from one KD-tree query
+	Coordinates=Source if isinstance(Source,np.ndarray) else GetPointCoordinates(Source)
+	_,Ids=cKDTree(Coordinates).query(np.asarray(Points,dtype=np.float64).reshape(-1,3),k=1,workers=-1)
+	return Ids
+
+def TransferArrays(Source,Target,ArrayNames,Ids=None):
+	#Copies point arrays (names or indices) of Source to the points of Target,
+	#each taking the value of the closest source point, e.g. TerritoryMaps and
+	#MBF from the myocardium volume to a surface. Ids from ClosestPointIds can
+	#be given to reuse a query
+	if Ids is None:
+		Ids=ClosestPointIds(Source,GetPointCoordinates(Target))
+	for ArrayName in ArrayNames:
+		SourceArray=Source.GetPointData().GetArray(ArrayName)
+		if SourceArray is None:
+			print(f"--- Array {ArrayName} not found in the point data, it is not transferred")
+			continue
+		TargetArray=numpy_to_vtk(vtk_to_numpy(SourceArray)[Ids],deep=True,array_type=SourceArray.GetDataType())
+		TargetArray.SetName(SourceArray.GetName())
+		Target.GetPointData().AddArray(TargetArray)
+	return Target
+
+############ Surface Properties ##################
+def SurfaceStamp(Surface):
+	#Hash of the points and cells of a surface: the same geometry gives the
+	#same stamp, whatever object it is held in
+	Hash=hashlib.md5()
+	Offsets,Connectivity=GetCellConnectivity(Surface)
+	for Array in (GetPointCoordinates(Surface),Offsets,Connectivity):
+		Hash.update(np.ascontiguousarray(Array).view(np.uint8))
+	return Hash.hexdigest()
+
+class SurfaceCache():
+	#Triangulated and cleaned copies of surfaces and their mass properties,
+	#computed once per surface. Entries are keyed by the SurfaceStamp of the
+	#surface or by a key such as the FileStamp of the file it came from. The
+	#least recently used entries are dropped beyond Size numbers and beyond
+	#SurfaceSize triangulated surfaces, which are kept for the few surfaces
+	#of one analysis only
+	def __init__(self,Size=256,SurfaceSize=4):
+		self.Size=Size
+		self.SurfaceSize=SurfaceSize
+		self.Entries=OrderedDict()
+		self.Surfaces=OrderedDict()
+
+	def Lookup(self,Entries,Key,Compute,Size):
+		if Key in Entries:
+			Entries.move_to_end(Key)
+			return Entries[Key]
+		Entries[Key]=Compute()
+		while len(Entries)>Size:
+			Entries.popitem(last=False)
+		return Entries[Key]
+
+	def Triangulated(self,Surface,Key=None):
+		if Key is None:
+			Key=SurfaceStamp(Surface)
+		return self.Lookup(self.Surfaces,Key,lambda: TriangulateAndClean(Surface),self.SurfaceSize)
+
+	def Properties(self,Surface,Key=None):
+		#Volume, surface area and normalized shape index from one vtkMassProperties
+		if Key is None:
+			Key=SurfaceStamp(Surface)
+		def Compute():
+			Mass=vtk.vtkMassProperties()
+			Mass.SetInputData(self.Triangulated(Surface,Key))
+			Mass.Update()
+			return {"Volume":Mass.GetVolume(),"SurfaceArea":Mass.GetSurfaceArea(),"NormalizedShapeIndex":Mass.GetNormalizedShapeIndex()}
+		return self.Lookup(self.Entries,Key,Compute,self.Size)
+
+	def Clear(self):
+		self.Entries.clear()
+		self.Surfaces.clear()
+
+SurfaceProcessing=SurfaceCache()
+
+def VertexAreas(Surface):
+	#Area that belongs to every point: a third of each triangle that uses it
+	if not np.all(np.diff(GetCellConnectivity(Surface)[0])==3):
+		Triangles=vtk.vtkTriangleFilter()
+		Triangles.SetInputData(Surface)
+		Triangles.Update()
+		Surface=Triangles.GetOutput()
+	Triangles=GetCellConnectivity(Surface)[1].reshape(-1,3)
+	Points=GetPointCoordinates(Surface).astype(np.float64)
+	Edge1=Points[Triangles[:,1]]-Points[Triangles[:,0]]
+	Edge2=Points[Triangles[:,2]]-Points[Triangles[:,0]]
+	Areas=0.5*np.linalg.norm(np.cross(Edge1,Edge2),axis=1)
+	return np.bincount(Triangles.ravel(),weights=np.repeat(Areas/3,3),minlength=Surface.GetNumberOfPoints())
+
+def TriangulateAndClean(Surface):
+	#Triangulated and cleaned copy of the surface, see TriangulateSurface
+	Triangles=vtk.vtkTriangleFilter()
+	Triangles.SetInputData(Surface)
+	Triangles.Update()
+	Cleaner=vtk.vtkCleanPolyData()
+	Cleaner.SetInputData(Triangles.GetOutput())
+	Cleaner.Update()
+	return Cleaner.GetOutput()
+
+def TriangulateSurface(Surface,Key=None):
+	#Shared by all callers, so the output must not be modified (ShallowCopy it first)
+	return SurfaceProcessing.Triangulated(Surface,Key)
+
+def SurfaceProperties(Surface,Key=None):
+	return SurfaceProcessing.Properties(Surface,Key)
+
 ############# Mesh Morphing Functions ###############
         #Create a line from apex and centroid of the myocardium
         
@@ -195,9 +761,10 @@ def TagOuterSurface(Surface):
 	#Get Centroid
 	Centroid=np.array(GetCentroid(Surface))
 
-	#Loop over all the points. 
+	#Loop over all the points.
+	SurfacePoints=GetPointCoordinates(Surface)
 	for i in range(Surface.GetNumberOfPoints()):
-		pSource=np.array(Surface.GetPoint(i))
+		pSource=np.array(SurfacePoints[i],dtype=float)
 		pTarget=pSource+np.array((pSource-Centroid))*5
 		code = obbTree.IntersectWithLine(pSource, pTarget, pointsVTKintersection, None)
 		X=pointsVTKintersection.GetData().GetNumberOfTuples()
@@ -278,6 +845,16 @@ def ThresholdByUpper(Volume,arrayname,value):
 	Threshold.Update()
 	return Threshold.GetOutput()
 
+def RemoveBoundaryLayers(Volume,Layers,arrayname="LayerIndex"):
+	#Keep the cells that are at least "Layers" layers away from the wall.
+	#The LayerIndex array is written by ImageAnalysisMyocardiumRemoveBoundaryData
+	if Layers<=0:
+		return Volume
+	if Volume.GetPointData().GetArray(arrayname) is None:
+		print ("Error. The array %s was not found, run ImageAnalysisMyocardiumRemoveBoundaryData first"%arrayname)
+		exit(1)
+	return ThresholdByUpper(Volume,arrayname,Layers)
+
 def ThresholdPointsByUpper(PolyData,arrayname,value):
 	Threshold=vtk.vtkThresholdPoints()
 	Threshold.SetInputData(PolyData)
@@ -327,16 +904,193 @@ def ConvertPointsToLine(PointsArray):
         return polyData
 
 
-def Statistics(Volume,ArrayName,NormalizationValue=None):
+############ Statistics Engine ##################
+class StreamingMoments():
+	#Mean, standard deviation, skewness and kurtosis from one pass over the
+	#data, which can be fed in chunks (e.g. territory by territory or from
+	#disk). Power sums are taken around a fixed shift to keep them accurate.
+	#Skewness and kurtosis are the biased (Fisher) estimates, as in scipy
+	def __init__(self):
+		self.N=0
+		self.Shift=None
+		self.Sums=np.zeros(4)
+		self.Min=np.inf
+		self.Max=-np.inf
+
+	def Update(self,Values):
+		Values=np.asarray(Values,dtype=np.float64).ravel()
+		if len(Values)==0:
+			return self
+		if self.Shift is None:
+			self.Shift=Values[0]
+		D=Values-self.Shift
+		D2=D*D
+		self.Sums+=[D.sum(),D2.sum(),(D2*D).sum(),(D2*D2).sum()]
+		self.N+=len(Values)
+		self.Min=min(self.Min,Values.min())
+		self.Max=max(self.Max,Values.max())
+		return self
+
+	def Merge(self,Other):
+		#Combine the moments of two chunks, e.g. from different processes
+		if Other.N==0:
+			return self
+		if self.N==0:
+			self.Shift=Other.Shift
+		#Move the power sums of Other to the shift of this accumulator
+		C=Other.Shift-self.Shift
+		S0,S1,S2,S3,S4=Other.N,*Other.Sums
+		self.Sums+=[S1+C*S0, S2+2*C*S1+C**2*S0, S3+3*C*S2+3*C**2*S1+C**3*S0, S4+4*C*S3+6*C**2*S2+4*C**3*S1+C**4*S0]
+		self.N+=Other.N
+		self.Min=min(self.Min,Other.Min)
+		self.Max=max(self.Max,Other.Max)
+		return self
+
+	def CentralMoments(self):
+		S1,S2,S3,S4=self.Sums/self.N
+		M2=S2-S1**2
+		M3=S3-3*S1*S2+2*S1**3
+		M4=S4-4*S1*S3+6*S1**2*S2-3*S1**4
+		return self.Shift+S1,max(M2,0.),M3,M4
+
+	def Mean(self):
+		return self.CentralMoments()[0]
+
+	def Std(self):
+		return np.sqrt(self.CentralMoments()[1])
+
+	def Skewness(self):
+		_,M2,M3,_=self.CentralMoments()
+		return M3/M2**1.5 if M2>0 else np.nan
+
+	def Kurtosis(self):
+		_,M2,_,M4=self.CentralMoments()
+		return M4/M2**2-3 if M2>0 else np.nan
+
+def Quantiles(Values,Probabilities,Sorted=False):
+	#Linearly interpolated quantiles (same as np.percentile) for all of the
+	#Probabilities from a single selection. Sorted=True skips the selection
+	Values=np.asarray(Values).ravel()
+	Position=np.asarray(Probabilities,dtype=np.float64)*(len(Values)-1)
+	Below=np.floor(Position).astype(np.int64)
+	Above=np.minimum(Below+1,len(Values)-1)
+	if not Sorted:
+		Values=np.partition(Values,np.unique(np.concatenate((Below,Above))))
+	Low=Values[Below]
+	High=Values[Above]
+	Fraction=Position-Below
+	Difference=High-Low
+	Result=np.where(Fraction>=0.5,High-Difference*(1-Fraction),Low+Difference*Fraction)
+	if np.issubdtype(Values.dtype,np.floating):
+		Result=Result.astype(Values.dtype)
+	return Result
+
+def SortedMode(SortedValues):
+	#Most frequent value of a sorted array (the smallest one on ties)
+	Starts=np.flatnonzero(np.concatenate(([True],SortedValues[1:]!=SortedValues[:-1])))
+	Counts=np.diff(np.append(Starts,len(SortedValues)))
+	return SortedValues[Starts[np.argmax(Counts)]]
+
+def ArrayChunks(Values,ChunkSize=1<<20):
+	#An array in chunks of ChunkSize values. Anything else is taken to be an
+	#iterable of chunks already (e.g. read from disk) and is passed through
+	if isinstance(Values,np.ndarray):
+		Values=Values.ravel()
+		return (Values[Start:Start+ChunkSize] for Start in range(0,len(Values),ChunkSize))
+	return Values
+
+def DescribeArray(Values,Approximate=False,ChunkSize=1<<20):
+	#Mean, std, median, quartiles and IQR of an array: one pass for the
+	#moments and one selection for all of the quantiles. With Approximate the
+	#values go through in chunks (Values can also be an iterable of chunks)
+	#and the quantiles come from a QuantileSketch, so the memory is bounded
+	if Approximate:
+		Moments=StreamingMoments()
+		Sketch=QuantileSketch()
+		for Chunk in ArrayChunks(Values,ChunkSize):
+			Moments.Update(Chunk)
+			Sketch.Update(Chunk)
+		Q25,Median,Q75=Sketch.Quantiles([0.25,0.5,0.75])
+	else:
+		Moments=StreamingMoments().Update(Values)
+		Q25,Median,Q75=Quantiles(Values,[0.25,0.5,0.75])
+	return {"Mean":Moments.Mean(),"std":Moments.Std(),"Median":Median,"IQR":Q75-Q25,"25thPerct":Q25,"75thPerct":Q75}
+
+class QuantileSketch():
+	#Bounded-memory approximate quantiles for data that does not fit in
+	#memory (KLL sketch). Level h keeps values that each stand for 2**h
+	#inputs, a full level is sorted and every other value is promoted.
+	#The rank error is about 1/K of the number of values
+	def __init__(self,K=2000,Seed=0):
+		self.K=K
+		self.Levels=[np.zeros(0)]
+		self.Random=np.random.default_rng(Seed)
+
+	def Capacity(self,Level):
+		#The top level holds K values, lower levels shrink by 2/3 per level
+		return max(int(np.ceil(self.K*(2./3)**(len(self.Levels)-1-Level))),2)
+
+	def Update(self,Values):
+		self.Levels[0]=np.concatenate((self.Levels[0],np.asarray(Values,dtype=np.float64).ravel()))
+		self.Compress()
+		return self
+
+	def Merge(self,Other):
+		for Level,Items in enumerate(Other.Levels):
+			if Level>=len(self.Levels):
+				self.Levels.append(np.zeros(0))
+			self.Levels[Level]=np.concatenate((self.Levels[Level],Items))
+		self.Compress()
+		return self
+
+	def Compress(self):
+		Level=0
+		while Level<len(self.Levels):
+			if len(self.Levels[Level])>self.Capacity(Level):
+				if Level+1==len(self.Levels):
+					self.Levels.append(np.zeros(0))
+				Items=np.sort(self.Levels[Level])
+				#An odd item out stays on this level
+				Keep=Items[:len(Items)%2]
+				Items=Items[len(Items)%2:]
+				Promoted=Items[self.Random.integers(2)::2]
+				self.Levels[Level]=Keep
+				self.Levels[Level+1]=np.concatenate((self.Levels[Level+1],Promoted))
+			Level+=1
+
+	def Quantiles(self,Probabilities):
+		Items=np.concatenate(self.Levels)
+		Weights=np.concatenate([np.full(len(Items_),2.**Level) for Level,Items_ in enumerate(self.Levels)])
+		Order=np.argsort(Items,kind="stable")
+		Items=Items[Order]
+		CumulativeWeights=np.cumsum(Weights[Order])
+		Ranks=np.asarray(Probabilities,dtype=np.float64)*CumulativeWeights[-1]
+		return Items[np.minimum(np.searchsorted(CumulativeWeights,Ranks),len(Items)-1)]
+
+def Statistics(Volume,ArrayName,NormalizationValue=None,Approximate=False):
 	statistics={"Volume":None, "Mean":None, "Stdev": None, "MeanNormalized":None, "StdevNormalized":None, "Median": None, "IQR":None, "Mode":None, "75thPerct": None, "Kurtosis": None, "Skewness":None, "Volume":None}
 
-	#Convert VTK array to numpy
+	#Convert VTK array to numpy. One pass gives all of the moments and one
+	#sort gives the quantiles and the mode. With Approximate the quantiles
+	#come from a QuantileSketch fed in chunks (no sorted copy), and there is
+	#no mode
 	Data_=vtk_to_numpy(Volume.GetPointData().GetArray(ArrayName))
-	statistics["Mean"]      =np.mean(Data_)
-	statistics["Stdev"]     =np.std(Data_)
-	statistics["75thPerct"] =np.percentile(Data_,75)
-	statistics["Median"]    =np.median(Data_)
-	statistics["IQR"]       =IQR(Data_)
+	if Approximate:
+		Moments=StreamingMoments()
+		Sketch=QuantileSketch()
+		for Chunk in ArrayChunks(Data_):
+			Moments.Update(Chunk)
+			Sketch.Update(Chunk)
+		Q25,Median,Q75=Sketch.Quantiles([0.25,0.5,0.75])
+	else:
+		Moments=StreamingMoments().Update(Data_)
+		SortedData=np.sort(Data_)
+		Q25,Median,Q75=Quantiles(SortedData,[0.25,0.5,0.75],Sorted=True)
+	statistics["Mean"]      =Moments.Mean()
+	statistics["Stdev"]     =Moments.Std()
+	statistics["75thPerct"] =Q75
+	statistics["Median"]    =Median
+	statistics["IQR"]       =Q75-Q25
 	if NormalizationValue is None:
 		statistics["MeanNormalized"]=statistics["Mean"]/statistics["75thPerct"]
 		statistics["StdevNormalized"]=statistics["Stdev"]/statistics["75thPerct"]
@@ -344,10 +1098,10 @@ def Statistics(Volume,ArrayName,NormalizationValue=None):
 		statistics["MeanNormalized"]=statistics["Mean"]/NormalizationValue
 		statistics["StdevNormalized"]=statistics["Stdev"]/NormalizationValue
 
-	statistics["Skewness"]   =SKEWNESS(Data_)
-	statistics["Kurtosis"]   =KURTOSIS(Data_)
-	statistics["Mode"]       =MODE(Data_)[0]	
-	
+	statistics["Skewness"]   =Moments.Skewness()
+	statistics["Kurtosis"]   =Moments.Kurtosis()
+	statistics["Mode"]       =np.nan if Approximate else SortedMode(SortedData)
+
 
 	Mass = vtk.vtkIntegrateAttributes()
 	Mass.SetInputData(Volume)